@@ -1,11 +1,42 @@
+import math
+from functools import lru_cache
+
 from qgis.core import (
     QgsGeometry, QgsPointXY,
     QgsCoordinateReferenceSystem,
     QgsCoordinateTransform,
-    QgsProject
+    QgsCoordinateTransformContext
 )
 
 
+_WGS84 = QgsCoordinateReferenceSystem("EPSG:4326")
+_METRIC = QgsCoordinateReferenceSystem("EPSG:3857")
+# Contexto local: pipeline por defecto, sin consultar transformaciones del proyecto
+_CTX = QgsCoordinateTransformContext()
+
+# Radio de la esfera de EPSG:3857 (Web Mercator)
+_MERCATOR_R = 6378137.0
+_BUFFER_SEGMENTS = 48
+
+
+@lru_cache(maxsize=32)
+def _get_transform(src_authid: str, dst_authid: str) -> QgsCoordinateTransform:
+    """Transformación cacheada por par de CRS (evita reconstruir el pipeline PROJ)."""
+    return QgsCoordinateTransform(
+        QgsCoordinateReferenceSystem(src_authid),
+        QgsCoordinateReferenceSystem(dst_authid),
+        _CTX,
+    )
+
+
+def _transform_for(src: QgsCoordinateReferenceSystem, dst: QgsCoordinateReferenceSystem) -> QgsCoordinateTransform:
+    """Como _get_transform, a partir de los CRS. Los CRS personalizados (authid vacío)
+    no se cachean: su authid no los identifica."""
+    if src.authid() and dst.authid():
+        return _get_transform(src.authid(), dst.authid())
+    return QgsCoordinateTransform(src, dst, _CTX)
+
+
 def geom_from_xy(x: float, y: float, epsg_authid: str):
     crs = QgsCoordinateReferenceSystem(epsg_authid)
     pt = QgsPointXY(float(x), float(y))
@@ -16,25 +47,42 @@ def geom_from_xy(x: float, y: float, epsg_authid: str):
 def _buffer_meters_epsg4326(geom: QgsGeometry, crs: QgsCoordinateReferenceSystem, meters: float) -> QgsGeometry:
     """Crea un buffer (en metros) alrededor del centroid en WGS84.
 
-    Nota: usa EPSG:3857 como CRS métrico (aprox.) para distancias de pocos km.
+    Nota: el radio se mide en metros de EPSG:3857 (métrico aprox. para pocos km;
+    equivale a metros de terreno escalados por 1/cos(lat)). Si la entrada ya está en
+    EPSG:4326 se evalúan las fórmulas de Mercator esférico directamente (sin PROJ),
+    con el mismo resultado que la ruta vía QgsCoordinateTransform.
     """
-    wgs84 = QgsCoordinateReferenceSystem("EPSG:4326")
-    metric = QgsCoordinateReferenceSystem("EPSG:3857")
+    wgs84 = _WGS84.authid()
+    metric = _METRIC.authid()
+
+    if crs.authid() == wgs84:
+        c = geom.centroid().asPoint()
+        # Centro en Mercator (m), círculo de radio `meters` y vuelta a grados
+        mx = math.radians(c.x()) * _MERCATOR_R
+        my = math.log(math.tan(math.pi / 4.0 + math.radians(c.y()) / 2.0)) * _MERCATOR_R
+        r = float(meters)
+        pts = []
+        for i in range(_BUFFER_SEGMENTS):
+            t = 2.0 * math.pi * i / _BUFFER_SEGMENTS
+            x = mx + r * math.cos(t)
+            y = my + r * math.sin(t)
+            lat = math.degrees(2.0 * math.atan(math.exp(y / _MERCATOR_R)) - math.pi / 2.0)
+            pts.append(QgsPointXY(math.degrees(x / _MERCATOR_R), lat))
+        pts.append(pts[0])
+        return QgsGeometry.fromPolygonXY([pts])
 
     g_wgs = QgsGeometry(geom)
 
-    if crs.authid() != "EPSG:4326":
-        tr_to_wgs = QgsCoordinateTransform(crs, wgs84, QgsProject.instance())
-        g_wgs.transform(tr_to_wgs)
+    g_wgs.transform(_transform_for(crs, _WGS84))
 
-    tr_to_m = QgsCoordinateTransform(wgs84, metric, QgsProject.instance())
-    tr_to_wgs = QgsCoordinateTransform(metric, wgs84, QgsProject.instance())
+    tr_to_m = _get_transform(wgs84, metric)
+    tr_to_wgs = _get_transform(metric, wgs84)
 
     g_m = QgsGeometry(g_wgs)
     g_m.transform(tr_to_m)
 
     c = g_m.centroid()
-    buf_m = c.buffer(float(meters), 48)
+    buf_m = c.buffer(float(meters), _BUFFER_SEGMENTS)
 
     buf_wgs = QgsGeometry(buf_m)
     buf_wgs.transform(tr_to_wgs)
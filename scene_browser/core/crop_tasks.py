@@ -0,0 +1,582 @@
+import copy
+import hashlib
+import math
+import os
+import uuid
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+from osgeo import gdal, osr
+from qgis.core import QgsTask, QgsMessageLog, Qgis
+
+from .index_kernels import normalized_difference, INDEX_NODATA
+from .gdal_env import src_from_href
+
+
+INDEX_TILE_PX = 512
+
+# Landsat Collection 2 Level-2 Surface Reflectance scaling (matches GEE)
+LS_SR_MULT = 0.0000275
+LS_SR_ADD  = -0.2
+
+
+
+def _open_href(href: str):
+    """Dataset GDAL propio de un asset remoto. Un fallo lanza excepción.
+
+    Los Datasets GDAL no son thread-safe: cada llamada abre su propio handle (la
+    cabecera COG suele venir del cache de rangos /vsicurl/, compartido por proceso).
+    """
+    ds = gdal.OpenEx(src_from_href(href), gdal.OF_RASTER, open_options=["NUM_THREADS=ALL_CPUS"])
+    if ds is None:
+        raise RuntimeError(f"No se pudo abrir {str(href).split('?')[0]}")
+    return ds
+
+
+@lru_cache(maxsize=64)
+def _href_grid(href: str):
+    """(WKT, geotransform) de un asset remoto, reutilizado entre previews e índices.
+
+    Solo se cachean metadatos, nunca el Dataset. El href incluye el token SAS: al
+    rotar el token se abre una entrada nueva. Un fallo lanza excepción y no se cachea.
+    """
+    ds = _open_href(href)
+    return ds.GetProjection(), tuple(ds.GetGeoTransform())
+
+
+def clear_dataset_cache():
+    """Olvida los metadatos cacheados por _href_grid y libera el cache de rangos
+    /vsicurl/ (global del proceso: solo al descargar el plugin)."""
+    _href_grid.cache_clear()
+    gdal.VSICurlClearCache()
+
+
+def _grid_bounds_for_bbox(grid, bbox4326):
+    """Envolvente del bbox EPSG:4326 en el CRS de `grid` (WKT, geotransform),
+    ajustada hacia afuera a su grilla."""
+    wkt, gt = grid
+    return _grid_bounds(osr.SpatialReference(wkt=wkt), gt, bbox4326)
+
+
+def _grid_bounds(dst, gt, bbox4326):
+    """Como _grid_bounds_for_bbox, a partir de un SRS y un geotransform GDAL."""
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    dst.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    ct = osr.CoordinateTransformation(wgs84, dst)
+    x0, y0, x1, y1 = bbox4326
+    pts = [ct.TransformPoint(x, y)[:2] for x, y in ((x0, y0), (x0, y1), (x1, y0), (x1, y1))]
+    xs = [p[0] for p in pts]
+    ys = [p[1] for p in pts]
+    rx, ry = gt[1], -gt[5]
+    xmin = gt[0] + math.floor((min(xs) - gt[0]) / rx) * rx
+    xmax = gt[0] + math.ceil((max(xs) - gt[0]) / rx) * rx
+    ymax = gt[3] - math.floor((gt[3] - max(ys)) / ry) * ry
+    ymin = gt[3] - math.ceil((gt[3] - min(ys)) / ry) * ry
+    return xmin, ymin, xmax, ymax
+
+
+def _tmp_path(path: str) -> str:
+    """Temporal único junto a `path`: tareas concurrentes con la misma clave de cache
+    (mismo proceso QGIS) no escriben el mismo archivo antes del os.replace."""
+    return f"{path}.{uuid.uuid4().hex}.tmp"
+
+
+def _pmap(executor, fn, items, max_workers: int):
+    """map(fn, items) en paralelo conservando el orden: usa `executor` si se entrega
+    (pool persistente de la GUI) o un pool local de `max_workers` hilos.
+    """
+    items = list(items)
+    if executor is not None:
+        try:
+            results = executor.map(fn, items)  # map encola todo aquí; los errores de fn, al iterar
+        except RuntimeError:
+            # Pool ya apagado (dock cerrado con la tarea en curso): pool local
+            pass
+        else:
+            return list(results)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as ex:
+        return list(ex.map(fn, items))
+
+
+@lru_cache(maxsize=1)
+def _index_tiff_options() -> tuple:
+    """Opciones GTiff del índice: ZSTD + predictor flotante, o DEFLATE si GDAL no trae ZSTD."""
+    opts = ["TILED=YES", f"BLOCKXSIZE={INDEX_TILE_PX}", f"BLOCKYSIZE={INDEX_TILE_PX}",
+            "NUM_THREADS=ALL_CPUS", "BIGTIFF=IF_SAFER"]
+    drv = gdal.GetDriverByName("GTiff")
+    co_list = (drv.GetMetadataItem("DMD_CREATIONOPTIONLIST") or "") if drv else ""
+    if "ZSTD" in co_list:
+        opts += ["COMPRESS=ZSTD", "ZSTD_LEVEL=3", "PREDICTOR=3"]
+    else:
+        opts += ["COMPRESS=DEFLATE", "PREDICTOR=3"]
+    return tuple(opts)
+
+
+# data_type de la extensión STAC raster -> tipo GDAL en el XML VRT
+_STAC_GDAL_TYPES = {
+    "uint8": "Byte", "int8": "Int8", "uint16": "UInt16", "int16": "Int16",
+    "uint32": "UInt32", "int32": "Int32", "float32": "Float32", "float64": "Float64",
+}
+
+
+def _stac_grid(asset: dict):
+    """(geotransform GDAL, (cols, rows), tipo GDAL, nodata) de un asset STAC, o None.
+
+    Usa proj:transform/proj:shape y raster:bands (STAC projection/raster), sin abrir el COG.
+    """
+    tr = asset.get("proj:transform")
+    shape = asset.get("proj:shape")
+    bands = asset.get("raster:bands") or [{}]
+    dtype = _STAC_GDAL_TYPES.get(str(bands[0].get("data_type", "")).lower())
+    if not tr or len(tr) < 6 or not shape or len(shape) != 2 or dtype is None:
+        return None
+    # proj:transform es afín (a, b, c, d, e, f); el geotransform GDAL es (c, a, b, f, d, e)
+    gt = (float(tr[2]), float(tr[0]), float(tr[1]), float(tr[5]), float(tr[3]), float(tr[4]))
+    if gt[2] or gt[4]:
+        return None  # grillas rotadas: que resuelva BuildVRT
+    return gt, (int(shape[1]), int(shape[0])), dtype, bands[0].get("nodata")
+
+
+def _build_stack_vrt_xml(srcs, grids, epsg: int, bbox4326) -> str:
+    """XML de un VRT multibanda (una banda por fuente) recortado al bbox.
+
+    Todas las fuentes comparten CRS (`epsg`) y tipo de dato; cada banda lleva su
+    SrcRect en píxeles de su propia grilla, de modo que bandas de distinta resolución
+    se re-muestrean a la más fina. No abre ninguna fuente.
+    """
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(int(epsg))
+    finest = min(grids, key=lambda g: abs(g[0][1]))[0]
+    xmin, ymin, xmax, ymax = _grid_bounds(srs, finest, bbox4326)
+    rx, ry = abs(finest[1]), abs(finest[5])
+    width = int(round((xmax - xmin) / rx))
+    height = int(round((ymax - ymin) / ry))
+
+    root = ET.Element("VRTDataset", rasterXSize=str(width), rasterYSize=str(height))
+    ET.SubElement(root, "SRS").text = srs.ExportToWkt()
+    ET.SubElement(root, "GeoTransform").text = ", ".join(
+        repr(v) for v in (xmin, rx, 0.0, ymax, 0.0, -ry)
+    )
+    for i, (src, (gt, (cols, rows), dtype, nodata)) in enumerate(zip(srcs, grids), start=1):
+        band = ET.SubElement(root, "VRTRasterBand", dataType=dtype, band=str(i))
+        if nodata is not None:
+            ET.SubElement(band, "NoDataValue").text = repr(float(nodata))
+        source = ET.SubElement(band, "ComplexSource" if nodata is not None else "SimpleSource")
+        ET.SubElement(source, "SourceFilename", relativeToVRT="0").text = src
+        ET.SubElement(source, "SourceBand").text = "1"
+        ET.SubElement(source, "SourceProperties", RasterXSize=str(cols), RasterYSize=str(rows), DataType=dtype)
+        sx, sy = abs(gt[1]), abs(gt[5])
+        ET.SubElement(
+            source, "SrcRect",
+            xOff=repr((xmin - gt[0]) / sx), yOff=repr((gt[3] - ymax) / sy),
+            xSize=repr((xmax - xmin) / sx), ySize=repr((ymax - ymin) / sy),
+        )
+        ET.SubElement(source, "DstRect", xOff="0", yOff="0", xSize=str(width), ySize=str(height))
+        if nodata is not None:
+            ET.SubElement(source, "NODATA").text = repr(float(nodata))
+    return ET.tostring(root, encoding="unicode")
+
+
+def crop_assets_to_vrt(assets_dict, asset_names, bbox, out_dir: str, prefix: str, epsg=None,
+                       executor=None) -> str:
+    """VRT multibanda (una banda por asset) recortado al bbox EPSG:4326. Devuelve su ruta.
+
+    Si el item trae `epsg` y los assets traen metadatos proj/raster homogéneos, el XML
+    se arma directamente (sin abrir los COG); si no, se usa gdal.BuildVRT.
+    """
+    bbox_key = ",".join(f"{c:.5f}" for c in bbox)
+    hrefs = [str(assets_dict[a]["href"]) for a in asset_names]
+
+    # Un solo VRT (sin píxeles materializados) con la ventana del bbox. La clave
+    # incluye el token SAS porque el VRT lo embebe y debe regenerarse al rotar.
+    vkey = hashlib.blake2b(f"{'|'.join(hrefs)}|{bbox_key}".encode(), digest_size=8).hexdigest()
+    out_vrt = os.path.join(out_dir, f"{prefix}_{vkey}.vrt")
+    if os.path.exists(out_vrt) and os.path.getsize(out_vrt) > 0:
+        os.utime(out_vrt)  # LRU por mtime de la poda de cache
+        return out_vrt
+
+    grids = [_stac_grid(assets_dict[a]) for a in asset_names]
+    if epsg and all(grids) and len({g[2] for g in grids}) == 1:
+        xml = _build_stack_vrt_xml([src_from_href(h) for h in hrefs], grids, epsg, bbox)
+        tmp_vrt = _tmp_path(out_vrt)
+        with open(tmp_vrt, "w", encoding="utf-8") as fh:
+            fh.write(xml)
+        os.replace(tmp_vrt, out_vrt)
+        return out_vrt
+
+    # Metadatos remotos (cabecera COG) en paralelo; map conserva el orden de bandas
+    src_grids = _pmap(executor, _href_grid, hrefs, len(hrefs))
+    # BuildVRT no reproyecta: el bbox se lleva al CRS nativo de la escena y se
+    # ajusta a la grilla de la banda más fina (resolution="highest")
+    finest = min(src_grids, key=lambda g: abs(g[1][1]))
+    tmp_vrt = _tmp_path(out_vrt)
+    # Fuentes por nombre: BuildVRT abre sus propios handles en este hilo
+    vrt_ds = gdal.BuildVRT(
+        tmp_vrt,
+        [src_from_href(h) for h in hrefs],
+        options=gdal.BuildVRTOptions(
+            separate=True,
+            resolution="highest",
+            outputBounds=_grid_bounds_for_bbox(finest, bbox),
+        ),
+    )
+    vrt_ds = None  # cierra y escribe el XML antes de renombrar
+    os.replace(tmp_vrt, out_vrt)
+    return out_vrt
+
+
+@lru_cache(maxsize=1)
+def _norm_diff_supported() -> bool:
+    """Comprueba (una vez) si el GDAL de QGIS trae la pixel function VRT nativa "norm_diff".
+
+    El archivo de prueba lleva un sufijo único: dos tareas que prueban a la vez no
+    se pisan (un falso negativo quedaría cacheado toda la sesión).
+    """
+    src = f"/vsimem/scene_browser_norm_diff_probe_{uuid.uuid4().hex}.tif"
+    ds = gdal.GetDriverByName("GTiff").Create(src, 1, 1, 2, gdal.GDT_Float32)
+    ds.GetRasterBand(1).Fill(3)
+    ds.GetRasterBand(2).Fill(1)
+    ds = None
+    xml = (
+        '<VRTDataset rasterXSize="1" rasterYSize="1">'
+        '<VRTRasterBand dataType="Float32" band="1" subClass="VRTDerivedRasterBand">'
+        "<PixelFunctionType>norm_diff</PixelFunctionType>"
+        f"<SimpleSource><SourceFilename>{src}</SourceFilename><SourceBand>1</SourceBand></SimpleSource>"
+        f"<SimpleSource><SourceFilename>{src}</SourceFilename><SourceBand>2</SourceBand></SimpleSource>"
+        "</VRTRasterBand></VRTDataset>"
+    )
+    gdal.PushErrorHandler("CPLQuietErrorHandler")
+    try:
+        vrt = gdal.Open(xml)
+        val = vrt.ReadAsArray() if vrt is not None else None
+        vrt = None
+        return val is not None and abs(float(val[0][0]) - 0.5) < 1e-6  # (3-1)/(3+1)
+    except Exception:
+        return False
+    finally:
+        gdal.PopErrorHandler()
+        gdal.Unlink(src)
+
+
+def stretched_vrt_path(vrt_path: str, p_low, p_high) -> str:
+    """Ruta del VRT con el stretch p_low-p_high ya aplicado (hermano de `vrt_path`)."""
+    stem, ext = os.path.splitext(vrt_path)
+    return f"{stem}_p{p_low}-{p_high}{ext}"
+
+
+def bake_stretch_into_vrt(vrt_path: str, ranges, p_low, p_high) -> str:
+    """Escribe una copia del VRT cuyas bandas salen ya estiradas a Byte.
+
+    Cada fuente lleva un <LUT> vmin:1,vmax:255 (lineal, satura fuera del rango) y la
+    banda pasa a Byte con NoData 0: GDAL entrega el RGB listo para pintar, sin
+    contrast enhancement ni recalcular percentiles al reabrir el proyecto.
+    Devuelve la ruta del VRT estirado.
+
+    Limitación: el VRT embebe los hrefs firmados (token SAS de Planetary Computer),
+    así que una capa Landsat guardada en un proyecto deja de cargar al expirar el
+    token; basta con volver a generar el preview.
+    """
+    tree = ET.parse(vrt_path)
+    root = tree.getroot()
+    for band, (vmin, vmax) in zip(root.findall("VRTRasterBand"), ranges):
+        vmin, vmax = float(vmin), float(vmax)
+        if vmax <= vmin:
+            vmax = vmin + 1.0
+        band.set("dataType", "Byte")
+        nd = band.find("NoDataValue")
+        if nd is None:
+            nd = ET.SubElement(band, "NoDataValue")
+        nd.text = "0"
+        for src in band:
+            if not src.tag.endswith("Source"):
+                continue
+            src.tag = "ComplexSource"
+            for old in src.findall("LUT"):
+                src.remove(old)
+            ET.SubElement(src, "LUT").text = f"{vmin!r}:1,{vmax!r}:255"
+
+    out_vrt = stretched_vrt_path(vrt_path, p_low, p_high)
+    tmp_vrt = _tmp_path(out_vrt)
+    tree.write(tmp_vrt, encoding="unicode")
+    os.replace(tmp_vrt, out_vrt)
+    return out_vrt
+
+
+def crop_assets_to_index_vrt(assets_dict, mode: str, a1: str, a2: str, bbox, out_dir: str, prefix: str,
+                             executor=None):
+    """Índice (NDVI/NBR) como VRT derivado: (b1-b2)/(b1+b2) se evalúa al leer, sin
+    GeoTIFF intermedio. Devuelve la ruta del VRT, o None si no aplica (GDAL sin
+    "norm_diff" o bandas en distinto CRS) y debe usarse crop_assets_to_index_tif.
+    """
+    if not _norm_diff_supported():
+        return None
+    # Fallback SWIR2 (algunas colecciones usan "swir2" en vez de "swir22")
+    if mode.upper() == "NBR" and a2 not in assets_dict and "swir2" in assets_dict:
+        a2 = "swir2"
+
+    mode = mode.upper()
+    hrefs = [str(assets_dict[a]["href"]) for a in (a1, a2)]
+    bbox_key = ",".join(f"{c:.6f}" for c in bbox)
+    # El VRT embebe el token SAS: la clave usa el href firmado ("clamp": VRTs previos
+    # sin recorte a [-1, 1] no se reutilizan)
+    vkey = hashlib.blake2b(f"{mode}|clamp|{hrefs[0]}|{hrefs[1]}|{bbox_key}".encode(), digest_size=16).hexdigest()
+    out_vrt = os.path.join(out_dir, f"{prefix}_{mode}_{vkey}.vrt")
+    if os.path.exists(out_vrt) and os.path.getsize(out_vrt) > 0:
+        os.utime(out_vrt)  # LRU por mtime de la poda de cache
+        return out_vrt
+
+    grid1, grid2 = _pmap(executor, _href_grid, hrefs, 2)
+    srs1 = osr.SpatialReference(wkt=grid1[0])
+    srs2 = osr.SpatialReference(wkt=grid2[0])
+    if not srs1.IsSame(srs2):
+        return None
+
+    # Pila de 2 bandas en la grilla de la 1ra (SrcRect/DstRect re-muestrean la 2da)
+    stack = gdal.BuildVRT(
+        "",
+        [src_from_href(h) for h in hrefs],
+        options=gdal.BuildVRTOptions(
+            separate=True,
+            xRes=abs(grid1[1][1]),
+            yRes=abs(grid1[1][5]),
+            outputBounds=_grid_bounds_for_bbox(grid1, bbox),
+            resampleAlg="bilinear",
+        ),
+    )
+    root = ET.fromstring(stack.GetMetadata("xml:VRT")[0])
+    stack = None
+    bands = root.findall("VRTRasterBand")
+    if len(bands) != 2:
+        return None
+
+    derived = ET.Element("VRTRasterBand", dataType="Float32", band="1", subClass="VRTDerivedRasterBand")
+    ET.SubElement(derived, "NoDataValue").text = repr(INDEX_NODATA)
+    ET.SubElement(derived, "PixelFunctionType").text = "norm_diff"
+    ET.SubElement(derived, "SourceTransferType").text = "Float32"
+    do_scale = prefix.lower() == "ls"
+    for band in bands:
+        for src in list(band):
+            if not src.tag.endswith("Source"):
+                continue
+            if do_scale:
+                # Reflectancia Landsat C2 L2: b*mult + add antes del índice
+                src.tag = "ComplexSource"
+                ET.SubElement(src, "ScaleOffset").text = repr(LS_SR_ADD)
+                ET.SubElement(src, "ScaleRatio").text = repr(LS_SR_MULT)
+            derived.append(src)
+        root.remove(band)
+    root.append(derived)
+
+    tmp_vrt = _tmp_path(out_vrt)
+    with open(tmp_vrt, "w", encoding="utf-8") as fh:
+        fh.write(ET.tostring(_clamp_index_vrt(root), encoding="unicode"))
+    os.replace(tmp_vrt, out_vrt)
+    return out_vrt
+
+
+def _clamp_index_vrt(root):
+    """Envuelve el VRT derivado (en línea) en otro que recorta el índice a [-1, 1].
+
+    norm_diff no recorta y el escalado Landsat puede sacarlo de rango: un <LUT>
+    -1:-1,1:1 (identidad que satura en los extremos) iguala al GeoTIFF calculado.
+    El nodata del índice se excluye con <NODATA> y no pasa por el LUT.
+    """
+    width, height = root.get("rasterXSize"), root.get("rasterYSize")
+    outer = ET.Element("VRTDataset", rasterXSize=width, rasterYSize=height)
+    for tag in ("SRS", "GeoTransform"):
+        el = root.find(tag)
+        if el is not None:
+            outer.append(copy.deepcopy(el))
+    band = ET.SubElement(outer, "VRTRasterBand", dataType="Float32", band="1")
+    ET.SubElement(band, "NoDataValue").text = repr(INDEX_NODATA)
+    src = ET.SubElement(band, "ComplexSource")
+    ET.SubElement(src, "SourceFilename", relativeToVRT="0").text = ET.tostring(root, encoding="unicode")
+    ET.SubElement(src, "SourceBand").text = "1"
+    ET.SubElement(src, "SourceProperties", RasterXSize=width, RasterYSize=height, DataType="Float32")
+    ET.SubElement(src, "SrcRect", xOff="0", yOff="0", xSize=width, ySize=height)
+    ET.SubElement(src, "DstRect", xOff="0", yOff="0", xSize=width, ySize=height)
+    ET.SubElement(src, "NODATA").text = repr(INDEX_NODATA)
+    ET.SubElement(src, "LUT").text = "-1:-1,1:1"
+    return outer
+
+
+def crop_assets_to_index_tif(assets_dict, mode: str, a1: str, a2: str, bbox, out_dir: str, prefix: str,
+                             is_canceled=None, executor=None) -> str:
+    """Recorta 2 assets (COG) al bbox y calcula un índice (NDVI/NBR) en un GeoTIFF cacheado.
+    Re-muestrea la 2da banda a la grilla de la 1ra (p.ej. SWIR 20m vs NIR 10m).
+    Devuelve la ruta del GeoTIFF, o None si `is_canceled()` se activa a mitad de cálculo.
+    """
+    def _open_one(asset_name: str):
+        try:
+            return _open_href(str(assets_dict[asset_name]["href"]))
+        except RuntimeError:
+            raise RuntimeError(f"No se pudo abrir el asset {asset_name}.")
+
+    # Fallback SWIR2 (algunas colecciones usan "swir2" en vez de "swir22")
+    if mode.upper() == "NBR" and a2 not in assets_dict and "swir2" in assets_dict:
+        a2 = "swir2"
+
+    # Resultado cacheado por (modo, assets sin token SAS, bbox): reutilizar si existe
+    mode = mode.upper()
+    hrefs = [str(assets_dict[a]["href"]).split("?")[0] for a in (a1, a2)]
+    bbox_key = ",".join(f"{c:.6f}" for c in bbox)
+    cache_key = hashlib.blake2b(f"{mode}|{hrefs[0]}|{hrefs[1]}|{bbox_key}".encode(), digest_size=16).hexdigest()
+    out_idx = os.path.join(out_dir, f"{prefix}_{mode}_{cache_key}.tif")
+    if os.path.exists(out_idx) and os.path.getsize(out_idx) > 0:
+        os.utime(out_idx)
+        return out_idx
+
+    # Cada asset abre su propio Dataset: se solapan las latencias HTTP
+    # (HTTP/2 multiplex ya configurado en core.gdal_env)
+    src1, src2 = _pmap(executor, _open_one, [a1, a2], 2)
+
+    # Recorte perezoso (VRT sin archivo) de la banda 1: define la grilla de salida
+    ds1 = gdal.Translate(
+        "",
+        src1,
+        options=gdal.TranslateOptions(
+            projWin=[bbox[0], bbox[3], bbox[2], bbox[1]],
+            projWinSRS="EPSG:4326",
+            format="VRT",
+        ),
+    )
+    gt = ds1.GetGeoTransform()
+    xsize = ds1.RasterXSize
+    ysize = ds1.RasterYSize
+    xmin = gt[0]
+    ymax = gt[3]
+    xmax = xmin + gt[1] * xsize
+    ymin = ymax + gt[5] * ysize
+
+    srs1 = osr.SpatialReference(wkt=ds1.GetProjection())
+    srs2 = osr.SpatialReference(wkt=src2.GetProjection())
+    if srs1.IsSame(srs2):
+        # Mismo CRS (misma escena): la banda 2 se lee directamente en la grilla
+        # de la 1ra con projWin + outsize, sin Warp (GDAL usa overviews si aplica)
+        ds2m = gdal.Translate(
+            "",
+            src2,
+            options=gdal.TranslateOptions(
+                projWin=[xmin, ymax, xmax, ymin],
+                width=xsize,
+                height=ysize,
+                resampleAlg="bilinear",
+                format="VRT",
+            ),
+        )
+    else:
+        ds2m = gdal.Warp(
+            "",
+            src2,
+            options=gdal.WarpOptions(
+                format="MEM",
+                dstSRS=ds1.GetProjection(),
+                outputBounds=[xmin, ymin, xmax, ymax],
+                width=xsize,
+                height=ysize,
+                resampleAlg="bilinear",
+                multithread=True,
+                warpOptions=["NUM_THREADS=ALL_CPUS"],
+            ),
+        )
+
+    # Se escribe a un temporal y se renombra: la cache nunca ve un archivo a medias
+    tmp_idx = _tmp_path(out_idx)
+    drv = gdal.GetDriverByName("GTiff")
+    out_ds = drv.Create(
+        tmp_idx,
+        xsize,
+        ysize,
+        1,
+        gdal.GDT_Float32,
+        options=list(_index_tiff_options()),
+    )
+    out_ds.SetGeoTransform(ds1.GetGeoTransform())
+    out_ds.SetProjection(ds1.GetProjection())
+    ob = out_ds.GetRasterBand(1)
+    ob.SetNoDataValue(INDEX_NODATA)
+
+    # Cálculo por teselas alineadas a los bloques de salida: RAM acotada por tesela.
+    # Secuencial: los Datasets GDAL no son thread-safe y el kernel numba (prange) ya
+    # usa todos los núcleos; varias entradas concurrentes abortan su threading layer.
+    r1 = ds1.GetRasterBand(1)
+    r2 = ds2m.GetRasterBand(1)
+    # ✅ Apply reflectance scaling ONLY for Landsat C2 L2
+    # Sentinel-2 assets from EarthSearch are already reflectance-like; do not scale them.
+    do_scale = prefix.lower() == "ls"
+
+    t = INDEX_TILE_PX
+    for yoff in range(0, ysize, t):
+        for xoff in range(0, xsize, t):
+            if is_canceled is not None and is_canceled():
+                break
+            w = min(t, xsize - xoff)
+            h = min(t, ysize - yoff)
+            # Lectura directa a float32 en buffers propios de la tesela (sin copia astype)
+            b1 = np.empty((h, w), dtype=np.float32)
+            b2 = np.empty((h, w), dtype=np.float32)
+            r1.ReadAsArray(xoff, yoff, w, h, buf_obj=b1)
+            r2.ReadAsArray(xoff, yoff, w, h, buf_obj=b2)
+            # Escalado + índice + clip + nodata en una sola pasada (kernel numba si está disponible)
+            idx = normalized_difference(b1, b2, LS_SR_MULT, LS_SR_ADD, do_scale=do_scale)
+            ob.WriteArray(idx, xoff, yoff)
+
+    ob.FlushCache()
+    out_ds.FlushCache()
+    ob = None
+    out_ds = None
+    if is_canceled is not None and is_canceled():
+        os.remove(tmp_idx)
+        return None
+    os.replace(tmp_idx, out_idx)
+    return out_idx
+
+
+class CropToVrtTask(QgsTask):
+    """Recorta assets COG al bbox (EPSG:4326) en background.
+
+    - Sin `index_mode`: VRT multibanda con `asset_names` (preview RGB).
+    - Con `index_mode` ("NDVI"/"NBR"): GeoTIFF del índice a partir de 2 assets.
+    La ruta resultante queda en `out_path`; la capa QGIS se crea en el hilo de la GUI.
+    """
+    def __init__(self, description: str, out_dir: str, assets_dict: dict, asset_names, bbox4326,
+                 prefix: str, index_mode: str = None, epsg=None, executor=None):
+        super().__init__(description, QgsTask.CanCancel)
+        self.out_dir = out_dir
+        self.assets_dict = assets_dict
+        self.asset_names = list(asset_names)
+        self.bbox = bbox4326  # (xmin, ymin, xmax, ymax)
+        self.prefix = prefix
+        self.index_mode = index_mode
+        self.epsg = epsg  # proj:epsg del item STAC (opcional)
+        self.executor = executor  # pool persistente del dock (opcional)
+        self.out_path = None
+        self.error = None
+
+    def run(self):
+        try:
+            os.makedirs(self.out_dir, exist_ok=True)
+            if self.index_mode:
+                a1, a2 = self.asset_names[:2]
+                # VRT derivado (sin píxeles escritos); GeoTIFF calculado si GDAL no lo soporta
+                self.out_path = crop_assets_to_index_vrt(
+                    self.assets_dict, self.index_mode, a1, a2, self.bbox, self.out_dir, self.prefix,
+                    executor=self.executor,
+                ) or crop_assets_to_index_tif(
+                    self.assets_dict, self.index_mode, a1, a2, self.bbox, self.out_dir, self.prefix,
+                    is_canceled=self.isCanceled, executor=self.executor,
+                )
+            else:
+                self.out_path = crop_assets_to_vrt(
+                    self.assets_dict, self.asset_names, self.bbox, self.out_dir, self.prefix,
+                    epsg=self.epsg, executor=self.executor,
+                )
+            return self.out_path is not None and not self.isCanceled()
+        except Exception as e:
+            self.error = str(e)
+            QgsMessageLog.logMessage(self.error, "SceneBrowser", Qgis.Critical)
+            return False
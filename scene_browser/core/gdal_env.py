@@ -0,0 +1,133 @@
+import threading
+
+from osgeo import gdal
+
+
+# Opciones globales de GDAL. Solo afectan lecturas de red (/vsicurl/, /vsis3/...):
+# cache de rangos, tamaño de cada GET Range y HTTP/2. /vsicurl/ lee el tamaño de
+# bloque solo de la configuración global, así que no puede limitarse por prefijo.
+# Nada de VSI_CACHE, GDAL_CACHEMAX ni GDAL_NUM_THREADS: cambiarían cómo QGIS lee
+# todas sus capas locales; la decodificación multihilo va por Dataset
+# (NUM_THREADS en _open_href).
+_COG_CONFIG = {
+    "CPL_VSIL_CURL_CACHE_SIZE": "536870912",
+    # Menos GET Range: lecturas más grandes y rangos consecutivos fusionados
+    "CPL_VSIL_CURL_CHUNK_SIZE": "1048576",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "GDAL_HTTP_MULTIPLEX": "YES",
+    "GDAL_HTTP_VERSION": "2",
+}
+
+# Opciones que cambian el comportamiento (no solo el rendimiento) y que GDAL lee con
+# VSIGetPathSpecificOption: se aplican solo a los prefijos (servidor o bucket) de los
+# assets del plugin, para no afectar otras fuentes remotas o locales del usuario.
+# GDAL_INGESTED_BYTES_AT_OPEN no está aquí: GDAL la lee solo de forma global y
+# afectaría la apertura de todo archivo local.
+_COG_PATH_CONFIG = {
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif,.TIF,.tiff",
+    # Sin HEAD previo al primer GET: un round-trip menos por archivo abierto
+    "CPL_VSIL_CURL_USE_HEAD": "NO",
+    # Reintentos ante errores HTTP transitorios (p.ej. lecturas concurrentes a S3)
+    "GDAL_HTTP_MAX_RETRY": "3",
+    "GDAL_HTTP_RETRY_DELAY": "1",
+    # Buckets públicos requester-pays (EarthSearch Landsat): acceso sin firmar
+    "AWS_NO_SIGN_REQUEST": "YES",
+    "AWS_REQUEST_PAYER": "requester",
+}
+
+# SetPathSpecificOption: GDAL >= 3.6 (SetCredential en 3.5)
+_set_path_option = getattr(gdal, "SetPathSpecificOption", None) or getattr(gdal, "SetCredential", None)
+_clear_path_options = getattr(gdal, "ClearPathSpecificOptions", None) or getattr(gdal, "ClearCredentials", None)
+
+_CONFIGURED = False
+# Valores previos de cada opción, para dejar GDAL como estaba al descargar el plugin
+_PREVIOUS = {}
+# Prefijos VSI con opciones propias (se registran al ver cada servidor/bucket)
+_SCOPED_PREFIXES = set()
+_SCOPE_LOCK = threading.Lock()
+
+
+def _set_global(key, value):
+    if key not in _PREVIOUS:
+        _PREVIOUS[key] = gdal.GetConfigOption(key)
+    gdal.SetConfigOption(key, value)
+
+
+def configure_gdal_for_cog():
+    """Aplica (una sola vez por proceso) las opciones globales de GDAL para COGs remotos."""
+    global _CONFIGURED
+    if _CONFIGURED:
+        return
+    with _SCOPE_LOCK:
+        if _CONFIGURED:
+            return
+        for key, value in _COG_CONFIG.items():
+            _set_global(key, value)
+        _CONFIGURED = True
+
+
+def _vsi_prefix(vsi_path: str):
+    """Prefijo servidor/bucket de una ruta VSI remota ("/vsicurl/https://host/",
+    "/vsis3/bucket/"), o None si no es remota."""
+    for vsi in ("/vsicurl/", "/vsis3/"):
+        if vsi_path.startswith(vsi):
+            rest = vsi_path[len(vsi):]
+            if vsi == "/vsicurl/":
+                scheme, sep, tail = rest.partition("://")
+                if not sep:
+                    return None
+                return f"{vsi}{scheme}://{tail.split('/', 1)[0]}/"
+            return f"{vsi}{rest.split('/', 1)[0]}/"
+    return None
+
+
+def scope_cog_options(vsi_path: str):
+    """Aplica las opciones COG (una vez por prefijo) al servidor/bucket de `vsi_path`."""
+    prefix = _vsi_prefix(vsi_path)
+    if prefix is None or prefix in _SCOPED_PREFIXES:
+        return
+    with _SCOPE_LOCK:
+        if prefix in _SCOPED_PREFIXES:
+            return
+        if _set_path_option is not None:
+            for key, value in _COG_PATH_CONFIG.items():
+                _set_path_option(prefix, key, value)
+        else:
+            # GDAL < 3.5: sin opciones por ruta, quedan globales como antes
+            for key, value in _COG_PATH_CONFIG.items():
+                _set_global(key, value)
+        _SCOPED_PREFIXES.add(prefix)
+
+
+def src_from_href(href: str) -> str:
+    """Ruta VSI de GDAL para un href (http(s) -> /vsicurl/, s3:// -> /vsis3/ requester-pays).
+
+    Aplica las opciones COG al servidor/bucket del href (scope_cog_options).
+    """
+    configure_gdal_for_cog()
+    if not href:
+        return "/vsicurl/"
+    href = str(href)
+    if href.startswith('s3://'):
+        src = '/vsis3/' + href[len('s3://'):]
+    elif href.startswith('http://') or href.startswith('https://'):
+        src = '/vsicurl/' + href
+    else:
+        return href
+    scope_cog_options(src)
+    return src
+
+
+def reset_gdal_config():
+    """Restaura las opciones que configure_gdal_for_cog()/scope_cog_options() modificaron."""
+    global _CONFIGURED
+    with _SCOPE_LOCK:
+        for key, value in _PREVIOUS.items():
+            gdal.SetConfigOption(key, value)
+        _PREVIOUS.clear()
+        if _clear_path_options is not None:
+            for prefix in _SCOPED_PREFIXES:
+                _clear_path_options(prefix)
+        _SCOPED_PREFIXES.clear()
+        _CONFIGURED = False
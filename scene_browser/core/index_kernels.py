@@ -0,0 +1,92 @@
+import threading
+
+import numpy as np
+
+try:
+    # numba no viene con QGIS; si está instalado se usa el kernel compilado
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    # numexpr (opcional) evalúa b*m+a por bloques y en varios hilos
+    import numexpr
+except ImportError:
+    numexpr = None
+
+
+INDEX_NODATA = -9999.0
+# A partir de este nº de píxeles compensa el arranque de numexpr
+_NUMEXPR_MIN_PIXELS = 4_000_000
+# El threading layer por defecto de numba (workqueue) aborta el proceso si dos hilos
+# entran a la vez en un kernel parallel=True: una sola entrada concurrente
+_NUMBA_LOCK = threading.Lock()
+
+
+def _scale_inplace(b, scale_mult, scale_add):
+    """b = b*scale_mult + scale_add sin temporales del tamaño de la banda."""
+    if numexpr is not None and b.size >= _NUMEXPR_MIN_PIXELS:
+        numexpr.evaluate("b * m + a", local_dict={"b": b, "m": scale_mult, "a": scale_add},
+                         out=b, casting="same_kind")
+    else:
+        np.multiply(b, scale_mult, out=b)
+        np.add(b, scale_add, out=b)
+
+
+def _normalized_difference_numpy(b1, b2, out, scale_mult, scale_add, do_scale):
+    # In-place: b1/b2 se reutilizan como buffers (escalado y denominador)
+    if do_scale:
+        _scale_inplace(b1, scale_mult, scale_add)
+        _scale_inplace(b2, scale_mult, scale_add)
+    np.subtract(b1, b2, out=out)
+    den = np.add(b1, b2, out=b2)
+    valid = den != 0
+    with np.errstate(invalid="ignore"):
+        np.divide(out, den, out=out, where=valid)
+    # La finitud se comprueba sobre el resultado: cubre NaN/inf en numerador y denominador
+    valid &= np.isfinite(out)
+    np.clip(out, -1.0, 1.0, out=out, where=valid)
+    # Máscara invertida in situ (sin el temporal de ~valid) y relleno sin indexado booleano
+    invalid = np.logical_not(valid, out=valid)
+    np.copyto(out, INDEX_NODATA, where=invalid)
+    return out
+
+
+if numba is not None:
+    # Sin nnan/ninf en fastmath: el control de no-finitos debe conservarse
+    @numba.njit(parallel=True, fastmath={"nsz", "arcp", "contract", "afn", "reassoc"}, cache=True)
+    def _normalized_difference_numba(b1, b2, out, scale_mult, scale_add, do_scale):
+        rows, cols = b1.shape
+        for i in numba.prange(rows):
+            for j in range(cols):
+                v1 = b1[i, j]
+                v2 = b2[i, j]
+                if do_scale:
+                    v1 = v1 * scale_mult + scale_add
+                    v2 = v2 * scale_mult + scale_add
+                s = v1 + v2
+                d = (v1 - v2) / s if s != 0 else np.nan
+                if np.isfinite(d):
+                    out[i, j] = min(1.0, max(-1.0, d))
+                else:
+                    out[i, j] = INDEX_NODATA
+        return out
+else:
+    _normalized_difference_numba = None
+
+
+def normalized_difference(b1, b2, scale_mult=1.0, scale_add=0.0, do_scale=False):
+    """Índice (b1-b2)/(b1+b2) en float32, recortado a [-1, 1], en una sola pasada.
+
+    Opcionalmente aplica antes `b*scale_mult + scale_add` a ambas bandas
+    (reflectancia Landsat C2 L2). Píxeles con suma 0 o no finitos -> INDEX_NODATA.
+    Puede modificar `b1`/`b2` (se usan como buffers de trabajo).
+    """
+    b1 = np.ascontiguousarray(b1, dtype=np.float32)
+    b2 = np.ascontiguousarray(b2, dtype=np.float32)
+    out = np.empty_like(b1)
+    args = (b1, b2, out, np.float32(scale_mult), np.float32(scale_add), bool(do_scale))
+    if _normalized_difference_numba is not None:
+        with _NUMBA_LOCK:
+            return _normalized_difference_numba(*args)
+    return _normalized_difference_numpy(*args)
@@ -1,8 +1,20 @@
+import math
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from osgeo import gdal
 from qgis.core import QgsTask, QgsMessageLog, Qgis
 
 
+_HIST_BINS = 4096
+_EXACT_HIST_BINS = 65536
+_CANCEL_CHECK_BLOCKS = 16
+# Tipos enteros sin signo cuyo histograma exacto es un bincount: tipo GDAL -> nº de valores
+_INT_HIST_BINS = {gdal.GDT_Byte: 256, gdal.GDT_UInt16: 65536}
+# Lado máximo (px) de la muestra leída para percentiles: 2/98 son estables a esta escala
+_SAMPLE_MAX_PX = 512
+
+
 class PercentileStretchTask(QgsTask):
     """
     Calcula percentiles 2-98 para un raster multibanda (3 bandas) en background.
@@ -15,45 +27,133 @@ class PercentileStretchTask(QgsTask):
         self.result = None
         self.error = None
 
+    def _percentiles_from_hist(self, counts, mn: float, mx: float):
+        """Invierte la CDF del histograma (bins uniformes en [mn, mx]) para p_low/p_high.
+
+        Interpolación lineal dentro del bin, ambos percentiles en una sola llamada.
+        """
+        counts = np.asarray(counts, dtype=np.float64)
+        cdf = np.empty(len(counts) + 1, dtype=np.float64)
+        cdf[0] = 0.0
+        np.cumsum(counts, out=cdf[1:])
+        cdf /= cdf[-1]
+        edges = np.linspace(mn, mx, len(counts) + 1)
+        vmin, vmax = np.interp([self.p_low / 100.0, self.p_high / 100.0], cdf, edges)
+        return float(vmin), float(vmax)
+
+    def _hist_percentiles(self, band):
+        """Percentiles aproximados a partir del histograma GDAL (sin leer la banda a RAM).
+
+        Devuelve None si GDAL no entrega histograma utilizable.
+        """
+        try:
+            mn, mx = band.ComputeRasterMinMax(True)
+            mn, mx = float(mn), float(mx)
+            hist = band.GetHistogram(mn, mx, _HIST_BINS, include_out_of_range=0, approx_ok=1)
+        except Exception:
+            return None
+        if not hist or mx <= mn or sum(hist) < 100:
+            return None
+        vmin, vmax = self._percentiles_from_hist(hist, mn, mx)
+        if vmax <= vmin:
+            return None
+        return vmin, vmax
+
+    def _iter_valid_blocks(self, band, buf_type=gdal.GDT_Float32):
+        """Recorre la banda por bloques nativos y entrega los valores válidos de cada uno.
+
+        Si la banda supera _SAMPLE_MAX_PX de lado, cada ventana se lee diezmada
+        (buf_xsize/buf_ysize): GDAL sirve la lectura desde overviews cuando existen.
+        Se detiene antes de tiempo si la tarea se cancela.
+        """
+        bx, by = band.GetBlockSize()
+        xsize, ysize = band.XSize, band.YSize
+        step = max(1, math.ceil(max(xsize, ysize) / _SAMPLE_MAX_PX))
+        # Ventanas de varios bloques, para que cada lectura diezmada rinda >= 1 px por lado
+        bx, by = bx * step, by * step
+        nodata = band.GetNoDataValue()
+        n = 0
+        for yoff in range(0, ysize, by):
+            h = min(by, ysize - yoff)
+            for xoff in range(0, xsize, bx):
+                w = min(bx, xsize - xoff)
+                arr = band.ReadAsArray(
+                    xoff, yoff, w, h,
+                    buf_xsize=max(1, math.ceil(w / step)),
+                    buf_ysize=max(1, math.ceil(h / step)),
+                    buf_type=buf_type,
+                )
+                if arr is None:
+                    raise RuntimeError("No se pudo leer banda.")
+                arr = arr.ravel()
+                if arr.dtype.kind == "f":
+                    valid = np.isfinite(arr)
+                    if nodata is not None:
+                        valid &= arr != nodata
+                    yield arr[valid]
+                else:
+                    yield arr if nodata is None else arr[arr != nodata]
+                n += 1
+                if n % _CANCEL_CHECK_BLOCKS == 0 and self.isCanceled():
+                    return
+
     def _band_percentiles(self, band_index: int):
         ds = gdal.Open(self.raster_path)
         if ds is None:
             raise RuntimeError(f"No se pudo abrir raster: {self.raster_path}")
         band = ds.GetRasterBand(band_index)
-        arr = band.ReadAsArray()
-        if arr is None:
-            raise RuntimeError("No se pudo leer banda.")
-        nodata = band.GetNoDataValue()
-        arr = arr.astype(np.float32)
-        if nodata is not None:
-            arr = arr[arr != nodata]
-        arr = arr[np.isfinite(arr)]
-        if arr.size < 100:
-            mn = float(np.nanmin(arr)) if arr.size else 0.0
-            mx = float(np.nanmax(arr)) if arr.size else 1.0
+        approx = self._hist_percentiles(band)
+        if approx is not None:
+            return approx
+
+        # Byte/UInt16 (S2 L2A, Landsat C2): una sola pasada, conteo exacto por valor
+        nbins = _INT_HIST_BINS.get(band.DataType)
+        if nbins is not None:
+            hist = np.zeros(nbins, dtype=np.int64)
+            for vals in self._iter_valid_blocks(band, buf_type=band.DataType):
+                if vals.size:
+                    hist += np.bincount(vals, minlength=nbins)
+            nz = np.flatnonzero(hist)
+            if hist.sum() >= 100 and nz.size > 1:
+                vmin, vmax = self._percentiles_from_hist(hist, 0.0, float(nbins))
+                if vmax > vmin:
+                    return vmin, vmax
+                return float(nz[0]), float(nz[-1])
+
+        # Exacto (por bloques): 1ra pasada min/max, 2da pasada histograma fino
+        mn, mx, count = np.inf, -np.inf, 0
+        for vals in self._iter_valid_blocks(band):
+            if vals.size:
+                mn = min(mn, float(vals.min()))
+                mx = max(mx, float(vals.max()))
+                count += vals.size
+        if count < 100 or mx <= mn:
+            if not count:
+                mn, mx = 0.0, 1.0
             if mx <= mn:
                 mx = mn + 1.0
             return mn, mx
-        vmin = float(np.percentile(arr, self.p_low))
-        vmax = float(np.percentile(arr, self.p_high))
+
+        hist = np.zeros(_EXACT_HIST_BINS, dtype=np.int64)
+        for vals in self._iter_valid_blocks(band):
+            if vals.size:
+                hist += np.histogram(vals, bins=_EXACT_HIST_BINS, range=(mn, mx))[0]
+        vmin, vmax = self._percentiles_from_hist(hist, mn, mx)
         if vmax <= vmin:
-            vmin = float(np.min(arr))
-            vmax = float(np.max(arr))
-            if vmax <= vmin:
-                vmax = vmin + 1.0
+            vmin, vmax = mn, mx
         return vmin, vmax
 
     def run(self):
         try:
-            r = self._band_percentiles(1)
-            if self.isCanceled():
-                return False
-            g = self._band_percentiles(2)
-            if self.isCanceled():
-                return False
-            b = self._band_percentiles(3)
-            if self.isCanceled():
-                return False
+            # Cada banda abre su propio Dataset: GDAL permite leerlas en paralelo
+            with ThreadPoolExecutor(max_workers=3) as ex:
+                futures = [ex.submit(self._band_percentiles, i) for i in (1, 2, 3)]
+                results = []
+                for fut in futures:
+                    results.append(fut.result())
+                    if self.isCanceled():
+                        return False
+            r, g, b = results
             self.result = {"r": r, "g": g, "b": b}
             return True
         except Exception as e:
@@ -1,21 +1,162 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    # orjson no viene con QGIS; si está instalado decodifica respuestas grandes más rápido
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+
+# Con límites altos, rangos de varios años se dividen por año y se consultan en paralelo
+_SPLIT_MIN_LIMIT = 100
+_SPLIT_MAX_WORKERS = 4
+
+# Cache de respuestas de búsqueda: vigencia (s) y nº máximo de entradas. Con TTL, una
+# sesión larga de QGIS ve las escenas publicadas después de la primera búsqueda.
+_SEARCH_CACHE_TTL = 600
+_SEARCH_CACHE_MAX = 64
+
+
+def _split_datetime_by_year(datetime_range: str):
+    """Divide 'inicio/fin' (ISO 8601, UTC) en intervalos que no cruzan años."""
+    try:
+        start_s, end_s = datetime_range.split("/")
+        start = datetime.fromisoformat(start_s.replace("Z", "+00:00"))
+        end = datetime.fromisoformat(end_s.replace("Z", "+00:00"))
+    except ValueError:
+        return [datetime_range]
+    if start.year >= end.year:
+        return [datetime_range]
+
+    def _fmt(d):
+        return d.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    chunks = []
+    cur = start
+    for year in range(start.year, end.year):
+        year_end = datetime(year, 12, 31, 23, 59, 59, tzinfo=timezone.utc)
+        chunks.append(f"{_fmt(cur)}/{_fmt(year_end)}")
+        cur = datetime(year + 1, 1, 1, tzinfo=timezone.utc)
+    chunks.append(f"{_fmt(cur)}/{_fmt(end)}")
+    return chunks
+
+
+def _feature_datetime(f):
+    p = f.get("properties", {})
+    return p.get("datetime") or p.get("start_datetime") or ""
+
+
+def make_http_session(pool_connections=4, pool_maxsize=8):
+    """requests.Session con pool de conexiones, gzip y reintentos ante 429/5xx.
+
+    Sin reintentos por timeout de lectura: la búsqueda corre en el hilo de la GUI y
+    cada intento puede bloquear `timeout` segundos. Solo se reintentan fallos de
+    conexión y, como mucho dos veces, las respuestas 429/5xx.
+    """
+    session = requests.Session()
+    retry = Retry(
+        total=4,
+        connect=2,
+        read=0,
+        status=2,
+        backoff_factor=0.5,
+        status_forcelist=[429, 502, 503, 504],
+        allowed_methods=frozenset({"GET", "POST"}),
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry))
+    session.headers["Accept-Encoding"] = "gzip"
+    return session
 
 
 class StacClient:
-    def __init__(self, base_url: str, timeout: int = 60):
+    def __init__(self, base_url: str, timeout: int = 60, session=None):
         self.base_url = base_url.rstrip("/")
         self.timeout = timeout
+        self._url = f"{self.base_url}/search"
+        self._base_payload = {"collections": None, "bbox": None, "datetime": None, "limit": 30}
+        # Sesión persistente: reutiliza la conexión TCP/TLS entre búsquedas.
+        # Puede compartirse con otros clientes (p.ej. tokens PC) vía `session`.
+        self._session = session if session is not None else make_http_session()
+        # Cache LRU por instancia: payload JSON canónico -> (instante, cuerpo de respuesta)
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()  # búsquedas por año en paralelo
 
-    def search(self, collections, bbox, datetime_range, limit=30, query=None):
-        url = f"{self.base_url}/search"
-        payload = {
-            "collections": collections,
-            "bbox": bbox,
-            "datetime": datetime_range,
-            "limit": int(limit),
-        }
+    def _post_search(self, payload_json: str) -> bytes:
+        r = self._session.post(
+            self._url,
+            data=payload_json,
+            headers={"Content-Type": "application/json"},
+            timeout=self.timeout,
+        )
+        r.raise_for_status()
+        return r.content
+
+    def _search_cached(self, payload_json: str) -> bytes:
+        now = time.monotonic()
+        with self._cache_lock:
+            hit = self._cache.get(payload_json)
+            if hit is not None and now - hit[0] < _SEARCH_CACHE_TTL:
+                self._cache.move_to_end(payload_json)
+                return hit[1]
+        body = self._post_search(payload_json)
+        with self._cache_lock:
+            self._cache[payload_json] = (now, body)
+            self._cache.move_to_end(payload_json)
+            while len(self._cache) > _SEARCH_CACHE_MAX:
+                self._cache.popitem(last=False)
+        return body
+
+    def clear_cache(self):
+        with self._cache_lock:
+            self._cache.clear()
+
+    def _search_one(self, collections, bbox, datetime_range, limit, query):
+        payload = dict(self._base_payload)
+        payload["collections"] = list(collections)
+        payload["bbox"] = bbox
+        payload["datetime"] = datetime_range
+        payload["limit"] = int(limit)
         if query:
             payload["query"] = query
-        r = requests.post(url, json=payload, timeout=self.timeout)
-        r.raise_for_status()
-        return r.json()
+        key = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+        # Se decodifica en cada llamada: el llamador puede modificar el dict sin tocar la cache
+        return _json_loads(self._search_cached(key))
+
+    def search(self, collections, bbox, datetime_range, limit=30, query=None):
+        """Búsqueda STAC (POST /search).
+
+        `bbox` y `datetime_range` van como parámetros propios de la API (no como
+        filtro CQL), que es la ruta indexada del servidor; `query` queda solo
+        para propiedades como eo:cloud_cover. Si `limit` es alto y el rango abarca
+        varios años, se consulta un intervalo por año en paralelo y se devuelven
+        las `limit` escenas más recientes.
+        """
+        bbox = tuple(float(c) for c in bbox)
+        # xmin > xmax es válido en STAC/GeoJSON (bbox que cruza el antimeridiano)
+        if (len(bbox) != 4 or bbox[1] > bbox[3]
+                or not all(-180.0 <= x <= 180.0 for x in bbox[0::2])
+                or not all(-90.0 <= y <= 90.0 for y in bbox[1::2])):
+            raise ValueError(f"bbox inválido (xmin, ymin, xmax, ymax): {bbox}")
+        if not datetime_range or not isinstance(datetime_range, str):
+            raise ValueError("datetime_range debe ser un intervalo STAC 'inicio/fin'.")
+
+        limit = int(limit)
+        chunks = _split_datetime_by_year(datetime_range) if limit >= _SPLIT_MIN_LIMIT else [datetime_range]
+        if len(chunks) == 1:
+            return self._search_one(collections, bbox, datetime_range, limit, query)
+
+        with ThreadPoolExecutor(max_workers=min(_SPLIT_MAX_WORKERS, len(chunks))) as ex:
+            pages = list(ex.map(lambda dt: self._search_one(collections, bbox, dt, limit, query), chunks))
+        feats = [f for page in pages for f in page.get("features", [])]
+        feats.sort(key=_feature_datetime, reverse=True)
+        return {"type": "FeatureCollection", "features": feats[:limit]}
@@ -1,26 +1,38 @@
+import hashlib
 import os
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 from osgeo import gdal
 from qgis.core import QgsTask, QgsMessageLog, Qgis
 
-def _src_from_href(href: str) -> str:
-    """Return GDAL VSI path for href; supports s3:// requester-pays."""
-    if not href:
-        return "/vsicurl/"
-    href = str(href)
-    if href.startswith('s3://'):
-        gdal.SetConfigOption('AWS_NO_SIGN_REQUEST', 'YES')
-        gdal.SetConfigOption('AWS_REQUEST_PAYER', 'requester')
-        return '/vsis3/' + href[len('s3://'):]
-    if href.startswith('http://') or href.startswith('https://'):
-        return '/vsicurl/' + href
-    return href
-
+from .gdal_env import src_from_href
 
 
 def _band_minmax(ds, band_index: int):
     b = ds.GetRasterBand(band_index)
+    # Stats already stored in metadata (no pixel reads)
+    try:
+        smin = b.GetMetadataItem("STATISTICS_MINIMUM")
+        smax = b.GetMetadataItem("STATISTICS_MAXIMUM")
+        if smin is not None and smax is not None:
+            mn, mx = float(smin), float(smax)
+            if mn != mx:
+                return mn, mx
+    except Exception:
+        pass
+
+    # Min/max from the smallest overview (far fewer pixels than the base)
+    try:
+        n_ov = b.GetOverviewCount()
+        if n_ov > 0:
+            mn, mx = b.GetOverview(n_ov - 1).ComputeRasterMinMax(True)
+            mn, mx = float(mn), float(mx)
+            if mn != mx:
+                return mn, mx
+    except Exception:
+        pass
+
     # Try fast stats; fall back to min/max
     try:
         stats = b.GetStatistics(True, True)  # approxOK=True, force=True
@@ -43,6 +55,62 @@ def _band_minmax(ds, band_index: int):
     return 0.0, 1.0
 
 
+_INDEX_NODATA = 0
+
+# Intermedios de thumbnails en memoria (GDAL /vsimem), nunca en disco
+VSIMEM_DIR = "/vsimem/scene_browser"
+
+
+def clear_vsimem():
+    """Libera los intermedios /vsimem que hayan quedado (p.ej. de tareas canceladas)."""
+    for name in gdal.ReadDir(VSIMEM_DIR) or []:
+        gdal.Unlink(f"{VSIMEM_DIR}/{name}")
+
+
+def _publish_png(tmp_png: str, png_path: str):
+    """Mueve el PNG temporal (y su .aux.xml, si GDAL lo escribió) a su ruta final."""
+    os.replace(tmp_png, png_path)
+    if os.path.exists(tmp_png + ".aux.xml"):
+        os.replace(tmp_png + ".aux.xml", png_path + ".aux.xml")
+
+
+def _scratch_tif(run_id: str, asset: str) -> str:
+    """GeoTIFF intermedio (/vsimem) de un asset para una ejecución de thumbnail."""
+    return f"{VSIMEM_DIR}/thumb_{run_id}_{asset}.tif"
+
+
+def _discard_scratch(vsimem_paths, tmp_png):
+    """Libera los intermedios /vsimem y el PNG temporal si no llegó a publicarse."""
+    for path in vsimem_paths:
+        if gdal.VSIStatL(path) is not None:
+            gdal.Unlink(path)
+    if tmp_png:
+        for path in (tmp_png, tmp_png + ".aux.xml"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def _normalized_difference_byte(b1, b2):
+    """Calcula (b1-b2)/(b1+b2) directamente en Byte: [-1, 1] -> [1, 255].
+
+    Aritmética entera sobre las bandas Int16/UInt16 (sin up-cast a float32);
+    0 queda reservado para nodata (suma no positiva).
+    """
+    num = b1.astype(np.int32)
+    den = num + b2
+    num -= b2
+    valid = den > 0
+    num += den
+    num *= 127
+    np.floor_divide(num, den, out=num, where=valid)
+    num += 1
+    np.clip(num, 1, 255, out=num)
+    np.copyto(num, _INDEX_NODATA, where=np.logical_not(valid, out=valid))
+    return num.astype(np.uint8)
+
+
 class ThumbnailTask(QgsTask):
     """Genera un thumbnail PNG real desde 3 assets COG (R,G,B) en un bbox (EPSG:4326).
 
@@ -61,145 +129,190 @@ class ThumbnailTask(QgsTask):
         self.png_path = None
         self.error = None
 
+    def _translate_assets(self, asset_names, run_id: str, **size_opts):
+        """Recorta cada asset al bbox en paralelo (un Dataset GDAL por hilo).
+
+        Devuelve los GeoTIFF (/vsimem, ver _scratch_tif) en el mismo orden que
+        `asset_names`, o None si la tarea se cancela. El llamador los libera, también
+        ante error o cancelación.
+        """
+        xmin, ymin, xmax, ymax = self.bbox
+
+        def _translate_one(a):
+            src = src_from_href(self.assets_dict[a]["href"])
+            out_tif = _scratch_tif(run_id, a)
+            gdal.Translate(
+                out_tif,
+                src,
+                options=gdal.TranslateOptions(
+                    projWin=[xmin, ymax, xmax, ymin],
+                    projWinSRS="EPSG:4326",
+                    format="GTiff",
+                    # Temporal de vida corta en RAM: sin compresión (sin costo zlib)
+                    creationOptions=["TILED=YES", "COMPRESS=NONE", "SPARSE_OK=TRUE", "BIGTIFF=IF_SAFER"],
+                    **size_opts,
+                ),
+            )
+            return out_tif
+
+        with ThreadPoolExecutor(max_workers=3) as ex:
+            futures = {ex.submit(_translate_one, a): i for i, a in enumerate(asset_names)}
+            tifs = [None] * len(asset_names)
+            for fut in as_completed(futures):
+                tifs[futures[fut]] = fut.result()
+                if self.isCanceled():
+                    for f in futures:
+                        f.cancel()
+                    return None
+        return tifs
+
+    def _cache_key(self) -> str:
+        """Clave estable del thumbnail: assets (href sin token SAS), bbox, tamaño y modo."""
+        first = self.rgb_assets[0] if self.rgb_assets else ""
+        mode = first.strip("_").upper() if isinstance(first, str) and first.startswith("__") else "RGB"
+        hrefs = tuple(
+            str((self.assets_dict.get(a) or {}).get("href", "")).split("?")[0]
+            for a in self.rgb_assets
+        )
+        ident = (tuple(self.rgb_assets), hrefs, [round(c, 6) for c in self.bbox], self.size_px, mode)
+        return hashlib.blake2b(repr(ident).encode(), digest_size=16).hexdigest()
+
     def run(self):
+        scratch = []  # intermedios /vsimem de esta ejecución
+        tmp_png = None
         try:
             os.makedirs(self.cache_dir, exist_ok=True)
-            uid = uuid.uuid4().hex
-            # Modo índice: rgb_assets = ["__NDVI__", nir, red] o ["__NBR__", nir, swir2]
-            if self.rgb_assets and isinstance(self.rgb_assets[0], str) and self.rgb_assets[0].startswith("__"):
-                mode = self.rgb_assets[0].strip("_").upper()
-                a1 = self.rgb_assets[1]
-                a2 = self.rgb_assets[2]
-                if mode == "NBR" and a2 not in self.assets_dict and "swir2" in self.assets_dict:
-                    a2 = "swir2"
-
-                tifs = []
-                for a in [a1, a2]:
-                    href = self.assets_dict[a]["href"]
-                    src = _src_from_href(href)
-                    out_tif = os.path.join(self.cache_dir, f"thumb_{uid}_{a}.tif")
-                    gdal.Translate(
-                        out_tif,
-                        src,
-                        options=gdal.TranslateOptions(
-                            projWin=[self.bbox[0], self.bbox[3], self.bbox[2], self.bbox[1]],
-                            projWinSRS="EPSG:4326",
-                            format="GTiff",
-                            width=self.size_px,
-                            height=self.size_px,
-                            creationOptions=["TILED=YES", "COMPRESS=DEFLATE"],
-                        ),
-                    )
-                    tifs.append(out_tif)
-
-                ds1 = gdal.Open(tifs[0]); ds2 = gdal.Open(tifs[1])
-                b1 = ds1.GetRasterBand(1).ReadAsArray().astype("float32")
-                b2 = ds2.GetRasterBand(1).ReadAsArray().astype("float32")
-                denom = (b1 + b2)
-                with np.errstate(divide='ignore', invalid='ignore'):
-                    idx = (b1 - b2) / denom
-                idx[~np.isfinite(idx)] = -9999.0
-
-                out_idx = os.path.join(self.cache_dir, f"thumb_{uid}_{mode}.tif")
-                drv = gdal.GetDriverByName("GTiff")
-                out_ds = drv.Create(out_idx, ds1.RasterXSize, ds1.RasterYSize, 1, gdal.GDT_Float32, options=["TILED=YES", "COMPRESS=DEFLATE"])
-                out_ds.SetGeoTransform(ds1.GetGeoTransform())
-                out_ds.SetProjection(ds1.GetProjection())
-                ob = out_ds.GetRasterBand(1)
-                ob.WriteArray(idx)
-                ob.SetNoDataValue(-9999.0)
-                ob.FlushCache()
-                out_ds.FlushCache()
-                out_ds = None
-
-                vrt = os.path.join(self.cache_dir, f"thumb_{uid}_{mode}.vrt")
-                gdal.BuildVRT(vrt, [out_idx, out_idx, out_idx], separate=True)
-
-                scale = [-1.0, 1.0, 0.0, 255.0]
-                png_path = os.path.join(self.cache_dir, f"thumb_{uid}.png")
-                gdal.Translate(
-                    png_path,
-                    vrt,
-                    options=gdal.TranslateOptions(
-                        format="PNG",
-                        outputType=gdal.GDT_Byte,
-                        scaleParams=[scale, scale, scale],
-                        noData=-9999.0,
-                    ),
-                )
-                self.png_path = png_path
+            uid = self._cache_key()
+            cached = os.path.join(self.cache_dir, f"thumb_{uid}.png")
+            if os.path.exists(cached) and os.path.getsize(cached) > 0:
+                self.png_path = cached
                 return True
+            # La clave estable solo nombra el PNG final; intermedios y PNG temporal llevan
+            # un sufijo por ejecución (dos tareas con la misma clave no se pisan)
+            run_id = f"{uid}_{uuid.uuid4().hex[:8]}"
+            tmp_png = os.path.join(self.cache_dir, f"thumb_{run_id}.tmp.png")
+            return self._render(run_id, tmp_png, cached, scratch)
 
-            tifs = []
+        except Exception as e:
+            self.error = str(e)
+            QgsMessageLog.logMessage(f"Thumbnail error: {self.error}", "SceneBrowser", Qgis.Warning)
+            return False
+        finally:
+            # Tras _render sus Datasets ya están cerrados: se liberan intermedios y PNG
+            # temporal también ante error o cancelación
+            _discard_scratch(scratch, tmp_png)
 
-            xmin, ymin, xmax, ymax = self.bbox
-            ulx, uly, lrx, lry = xmin, ymax, xmax, ymin
+    def _render(self, run_id: str, tmp_png: str, cached: str, scratch: list) -> bool:
+        """Genera el PNG en `tmp_png` y lo publica en `cached`; registra en `scratch`
+        los intermedios /vsimem que crea."""
+        # Modo índice: rgb_assets = ["__NDVI__", nir, red] o ["__NBR__", nir, swir2]
+        if self.rgb_assets and isinstance(self.rgb_assets[0], str) and self.rgb_assets[0].startswith("__"):
+            mode = self.rgb_assets[0].strip("_").upper()
+            a1 = self.rgb_assets[1]
+            a2 = self.rgb_assets[2]
+            if mode == "NBR" and a2 not in self.assets_dict and "swir2" in self.assets_dict:
+                a2 = "swir2"
 
-            for a in self.rgb_assets:
-                href = self.assets_dict[a]["href"]
-                src = _src_from_href(href)
-                out_tif = os.path.join(self.cache_dir, f"thumb_{uid}_{a}.tif")
+            # width/height + average: GDAL lee el overview COG acorde a size_px
+            # (p.ej. 8x/16x para un AOI de 3 km) en lugar de la resolución nativa
+            scratch.extend(_scratch_tif(run_id, a) for a in (a1, a2))
+            tifs = self._translate_assets(
+                [a1, a2], run_id, width=self.size_px, height=self.size_px, resampleAlg="average"
+            )
+            if tifs is None:
+                return False
 
-                gdal.Translate(
-                    out_tif,
-                    src,
-                    options=gdal.TranslateOptions(
-                        projWin=[ulx, uly, lrx, lry],
-                        projWinSRS="EPSG:4326",
-                        format="GTiff",
-                        creationOptions=["TILED=YES", "COMPRESS=DEFLATE"]
-                    )
-                )
-                tifs.append(out_tif)
+            ds1 = gdal.Open(tifs[0]); ds2 = gdal.Open(tifs[1])
+            b1 = ds1.GetRasterBand(1).ReadAsArray()
+            b2 = ds2.GetRasterBand(1).ReadAsArray()
+            idx = _normalized_difference_byte(b1, b2)
 
-                if self.isCanceled():
-                    return False
+            drv = gdal.GetDriverByName("MEM")
+            out_ds = drv.Create("", ds1.RasterXSize, ds1.RasterYSize, 1, gdal.GDT_Byte)
+            out_ds.SetGeoTransform(ds1.GetGeoTransform())
+            out_ds.SetProjection(ds1.GetProjection())
+            ob = out_ds.GetRasterBand(1)
+            ob.WriteArray(idx)
+            ob.SetNoDataValue(_INDEX_NODATA)
+            # Liberar buffers NumPy antes de exportar (menor pico de RSS)
+            del b1, b2, idx
 
-            vrt = os.path.join(self.cache_dir, f"thumb_{uid}.vrt")
-            gdal.BuildVRT(vrt, tifs, separate=True)
+            # bandList=[1,1,1] replica la banda: no hace falta un VRT intermedio
+            gdal.Translate(
+                tmp_png,
+                out_ds,
+                options=gdal.TranslateOptions(
+                    format="PNG",
+                    bandList=[1, 1, 1],
+                ),
+            )
+            ob = None
+            out_ds = None
+            ds1 = None
+            ds2 = None
+            _publish_png(tmp_png, cached)
+            self.png_path = cached
+            return True
 
-            ds = gdal.Open(vrt, gdal.GA_ReadOnly)
-            if ds is None:
-                raise RuntimeError("No se pudo abrir el VRT para calcular min/max.")
+        # VRT en memoria directamente sobre los COG remotos (sin GeoTIFF intermedios);
+        # el recorte con width/height hace que GDAL lea el overview más cercano.
+        xmin, ymin, xmax, ymax = self.bbox
+        srcs = [src_from_href(self.assets_dict[a]["href"]) for a in self.rgb_assets]
+        stack_vrt = f"{VSIMEM_DIR}/thumb_{run_id}_stack.vrt"
+        vrt = f"{VSIMEM_DIR}/thumb_{run_id}.vrt"
+        scratch.extend((stack_vrt, vrt))
+        gdal.BuildVRT(stack_vrt, srcs, separate=True)
+        gdal.Translate(
+            vrt,
+            stack_vrt,
+            options=gdal.TranslateOptions(
+                format="VRT",
+                projWin=[xmin, ymax, xmax, ymin],
+                projWinSRS="EPSG:4326",
+                width=self.size_px,
+                height=self.size_px,
+                resampleAlg="cubic",
+            ),
+        )
+        if self.isCanceled():
+            return False
 
-            mn1, mx1 = _band_minmax(ds, 1)
-            mn2, mx2 = _band_minmax(ds, 2)
-            mn3, mx3 = _band_minmax(ds, 3)
+        ds = gdal.Open(vrt, gdal.GA_ReadOnly)
+        if ds is None:
+            raise RuntimeError("No se pudo abrir el VRT para calcular min/max.")
 
-            # Avoid zero-range
-            def _fix(mn, mx):
-                if mn == mx:
-                    return mn, mn + 1.0
-                return mn, mx
+        mn1, mx1 = _band_minmax(ds, 1)
+        mn2, mx2 = _band_minmax(ds, 2)
+        mn3, mx3 = _band_minmax(ds, 3)
 
-            mn1, mx1 = _fix(mn1, mx1)
-            mn2, mx2 = _fix(mn2, mx2)
-            mn3, mx3 = _fix(mn3, mx3)
+        # Avoid zero-range
+        def _fix(mn, mx):
+            if mn == mx:
+                return mn, mn + 1.0
+            return mn, mx
 
-            png = os.path.join(self.cache_dir, f"thumb_{uid}.png")
+        mn1, mx1 = _fix(mn1, mx1)
+        mn2, mx2 = _fix(mn2, mx2)
+        mn3, mx3 = _fix(mn3, mx3)
 
-            gdal.Translate(
-                png,
-                vrt,
-                options=gdal.TranslateOptions(
-                    format="PNG",
-                    width=self.size_px,
-                    height=self.size_px,
-                    outputType=gdal.GDT_Byte,
-                    bandList=[1, 2, 3],
-                    scaleParams=[
-                        [mn1, mx1, 0, 255],
-                        [mn2, mx2, 0, 255],
-                        [mn3, mx3, 0, 255],
-                    ],
-                )
+        # Reusar el Dataset ya abierto (cache de bloques caliente, sin reabrir el VRT)
+        gdal.Translate(
+            tmp_png,
+            ds,
+            options=gdal.TranslateOptions(
+                format="PNG",
+                outputType=gdal.GDT_Byte,
+                bandList=[1, 2, 3],
+                scaleParams=[
+                    [mn1, mx1, 0, 255],
+                    [mn2, mx2, 0, 255],
+                    [mn3, mx3, 0, 255],
+                ],
             )
+        )
+        ds = None
+        _publish_png(tmp_png, cached)
 
-            self.png_path = png
-            QgsMessageLog.logMessage(f"Thumbnail listo: {png}", "SceneBrowser", Qgis.Info)
-            return True
-
-        except Exception as e:
-            self.error = str(e)
-            QgsMessageLog.logMessage(f"Thumbnail error: {self.error}", "SceneBrowser", Qgis.Warning)
-            return False
\ No newline at end of file
+        self.png_path = cached
+        QgsMessageLog.logMessage(f"Thumbnail listo: {cached}", "SceneBrowser", Qgis.Info)
+        return True
\ No newline at end of file
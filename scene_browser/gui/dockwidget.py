@@ -1,29 +1,13 @@
-import requests
 import os
-import uuid
-import numpy as np
-from functools import partial
-
-def _src_from_href(href: str) -> str:
-    """Return a GDAL VSI path for a STAC asset href.
-
-    EarthSearch Landsat assets may be s3:// (requester pays). We enable unsigned
-    requester-pays access and use /vsis3/. For http(s) we use /vsicurl/.
-    """
-    if not href:
-        return "/vsicurl/"  # will raise with clearer error downstream
-    href = str(href)
-    if href.startswith("s3://"):
-        # Public requester-pays bucket; unsigned access
-        gdal.SetConfigOption("AWS_NO_SIGN_REQUEST", "YES")
-        gdal.SetConfigOption("AWS_REQUEST_PAYER", "requester")
-        return "/vsis3/" + href[len("s3://"):]
-    if href.startswith("http://") or href.startswith("https://"):
-        return "/vsicurl/" + href
-    return href
-
-
-from qgis.PyQt.QtCore import QDate, QSize, Qt
+import re
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+
+from qgis.PyQt.QtCore import QDate, QSize, Qt, QTimer
 from qgis.PyQt.QtGui import QIcon, QPixmap, QImage, QPainter, QPen, QBrush
 from qgis.PyQt.QtWidgets import (
     QDockWidget, QWidget, QVBoxLayout, QHBoxLayout,
@@ -42,21 +26,76 @@ from qgis.core import (
     QgsCoordinateReferenceSystem, QgsCoordinateTransform
 )
 
-from osgeo import gdal
-
 from ..core.aoi import geom_from_xy, buffer_5km_epsg4326, buffer_3km_epsg4326
-from ..core.stac_client import StacClient
+from ..core.stac_client import StacClient, make_http_session
 from ..core.render_tasks import PercentileStretchTask
 from ..core.thumb_tasks import ThumbnailTask
+from ..core.crop_tasks import CropToVrtTask, bake_stretch_into_vrt, stretched_vrt_path
 
 
 EARTH_SEARCH_STAC = "https://earth-search.aws.element84.com/v1"
 PLANETARY_STAC = "https://planetarycomputer.microsoft.com/api/stac/v1"
 
 
-# Landsat Collection 2 Level-2 Surface Reflectance scaling (matches GEE)
-LS_SR_MULT = 0.0000275
-LS_SR_ADD  = -0.2
+# Vigencia asumida si el token PC no informa expiración; margen de renovación
+PC_TOKEN_DEFAULT_TTL = 45 * 60
+PC_TOKEN_REFRESH_MARGIN = 60
+
+
+def _pc_token_expiry(payload: dict, token: str) -> float:
+    """Epoch de expiración del token SAS (msft:expiry o parámetro 'se')."""
+    exp = payload.get("msft:expiry") or (parse_qs(token).get("se") or [None])[0]
+    if exp:
+        try:
+            return datetime.fromisoformat(str(exp).replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            pass
+    return time.time() + PC_TOKEN_DEFAULT_TTL
+
+
+# Cache persistente de recortes: índices (NDVI/NBR), VRT de preview y su versión
+# estirada (_p2-98); nº máximo de archivos conservados
+CROP_CACHE_MAX_FILES = 200
+_CROP_CACHE_RE = re.compile(
+    r"^(s2|ls)_(?:(NDVI|NBR)_[0-9a-f]{32}\.(tif|vrt)|[0-9a-f]{16}(_p\d+-\d+)?\.vrt)$"
+)
+
+
+def footprint_geometry(geojson_geom):
+    """QgsGeometry (EPSG:4326) a partir de la geometría GeoJSON de un item STAC."""
+    if not geojson_geom:
+        return None
+    gtype = geojson_geom.get("type")
+    coords = geojson_geom.get("coordinates") or []
+
+    def _ring(r):
+        return [QgsPointXY(float(c[0]), float(c[1])) for c in r]
+
+    if gtype == "Polygon":
+        return QgsGeometry.fromPolygonXY([_ring(r) for r in coords])
+    if gtype == "MultiPolygon":
+        return QgsGeometry.fromMultiPolygonXY([[_ring(r) for r in poly] for poly in coords])
+    return None
+
+
+def _bbox_tuple(geom):
+    """(xmin, ymin, xmax, ymax) del bounding box de una QgsGeometry."""
+    rect = geom.boundingBox()
+    return (rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum())
+
+
+def feature_epsg(feature):
+    """EPSG del item STAC (proj:epsg o proj:code "EPSG:n"), o None."""
+    props = feature.get("properties") or {}
+    epsg = props.get("proj:epsg")
+    if epsg is None:
+        code = str(props.get("proj:code") or "")
+        if code.upper().startswith("EPSG:"):
+            epsg = code[5:]
+    try:
+        return int(epsg) if epsg is not None else None
+    except (TypeError, ValueError):
+        return None
 
 
 def stac_datetime_range(date_ini_qdate: QDate, date_fin_qdate: QDate) -> str:
@@ -65,61 +104,97 @@ def stac_datetime_range(date_ini_qdate: QDate, date_fin_qdate: QDate) -> str:
     return f"{s}T00:00:00Z/{e}T23:59:59Z"
 
 
+# Preset -> assets (tablas estáticas: búsqueda O(1) en lugar de cadenas if/elif)
+_S2_PRESETS = {
+    "Natural": ("red", "green", "blue"),
+    "Infrarrojo": ("nir", "red", "green"),
+    "Agricultura": ("swir16", "nir", "blue"),
+    "NDVI": ("__NDVI__", "nir", "red"),
+    "NBR": ("__NBR__", "nir", "swir22"),
+}
+
+# Landsat: por posición, candidatos en orden de preferencia (o marcador de índice)
+_LS_PRESETS = {
+    "Natural": (("red",), ("green",), ("blue",)),
+    "Infrarrojo": (("nir08", "nir"), ("red",), ("green",)),
+    "Agricultura": (("swir16", "swir1"), ("nir08", "nir"), ("blue",)),
+    "NDVI": ("__NDVI__", ("nir08", "nir"), ("red",)),
+    "NBR": ("__NBR__", ("nir08", "nir"), ("swir22", "swir2")),
+}
+
+_RGB = ("red", "green", "blue")
+
+
 def s2_assets_for_preset(preset: str):
-    if preset == "Natural":
-        return ["red", "green", "blue"]
-    if preset == "Infrarrojo":
-        return ["nir", "red", "green"]
-    if preset == "Agricultura":
-        return ["swir16", "nir", "blue"]
-    if preset == "NDVI":
-        return ["__NDVI__", "nir", "red"]
-    if preset == "NBR":
-        return ["__NBR__", "nir", "swir22"]
-    return ["red", "green", "blue"]
+    return _S2_PRESETS.get(preset, _S2_PRESETS["Natural"])
 
 
 def s2_rgb_for_thumbnail():
-    return ["red", "green", "blue"]
+    return _RGB
 
 
-def ls_assets_for_preset(preset: str, available_assets):
-    def pick(name):
-        return name if name in available_assets else None
-
-    if preset == "Natural":
-        return [pick("red"), pick("green"), pick("blue")]
-    if preset == "Infrarrojo":
-        return [pick("nir08") or pick("nir"), pick("red"), pick("green")]
-    if preset == "Agricultura":
-        return [pick("swir16") or pick("swir1"), pick("nir08") or pick("nir"), pick("blue")]
-    if preset == "NDVI":
-        return ["__NDVI__", (pick("nir08") or pick("nir")), pick("red")]
-    if preset == "NBR":
-        return ["__NBR__", (pick("nir08") or pick("nir")), (pick("swir22") or pick("swir2"))]
-    return [pick("red"), pick("green"), pick("blue")]
+@lru_cache(maxsize=64)
+def ls_assets_for_preset(preset: str, available_assets: frozenset):
+    spec = _LS_PRESETS.get(preset, _LS_PRESETS["Natural"])
+    out = []
+    for cands in spec:
+        if isinstance(cands, str):
+            out.append(cands)
+        else:
+            out.append(next((c for c in cands if c in available_assets), None))
+    return tuple(out)
 
 
 def ls_rgb_for_thumbnail(available_assets):
-    rgb = [a for a in ["red", "green", "blue"] if a in available_assets]
+    rgb = [a for a in _RGB if a in available_assets]
     return rgb if len(rgb) == 3 else None
 
 
+# Despacho por sensor de los previews: etiqueta, resolución de assets del preset
+# (memoizada) y grupo de capas
+_PREVIEW_KINDS = {
+    "s2": ("S2", lambda preset, available: s2_assets_for_preset(preset), "Previews S2"),
+    "ls": ("Landsat", ls_assets_for_preset, "Previews Landsat"),
+}
+
+
 class SceneBrowserDock(QDockWidget):
     def __init__(self, iface):
         super().__init__("Visor de escenas Sentinel 2 y Landsat -Sernanp")
         self.iface = iface
 
-        self.stac_s2 = StacClient(EARTH_SEARCH_STAC)
-        self.stac_ls = StacClient(PLANETARY_STAC)  # usar Element84 para evitar signing/409
+        # Una sola sesión HTTP (pool compartido) para búsquedas STAC y tokens PC
+        self._http = make_http_session(pool_connections=16, pool_maxsize=32)
+        self.stac_s2 = StacClient(EARTH_SEARCH_STAC, session=self._http)
+        self.stac_ls = StacClient(PLANETARY_STAC, session=self._http)  # usar Element84 para evitar signing/409
 
         self._last_buffer = None  # QgsGeometry EPSG:4326 (5 km, para preview)
         self._last_thumb_buffer = None  # QgsGeometry EPSG:4326 (3 km, para thumbnails)
+        # (coordenadas AOI, (buffer 5 km, bbox), (buffer 3 km, bbox)): evita re-bufferizar
+        self._buffer_cache = (None, None, None)
 
         self._thumb_tasks = {}  # keep refs to tasks to avoid GC
+        self._crop_tasks = set()  # recortes (preview/índice) en curso, refs contra GC
+        # Pool persistente para las lecturas/cálculos paralelos de los recortes:
+        # sin crear hilos por clic y con conexiones GDAL/curl ya calientes
+        self._executor = None
+        # Límite de thumbnails simultáneos (evita saturar GDAL/S3 con lecturas concurrentes)
+        self._thumb_max_inflight = 4
+        self._thumb_inflight = 0
+        self._thumb_pending = deque()  # (key, task) a la espera de un hueco
+        self._icon_cache = OrderedDict()  # (png_path, mtime) -> QIcon (LRU)
+        self._icon_cache_max = 128
+        self._placeholder_icons = {}  # px -> QIcon gris
         self._last_feats = []
         self._last_thumb_kind = None
-        self._pc_token_cache = {}  # collection_id -> token
+        self._pc_token_cache = {}  # collection_id -> (token, expiry_epoch)
+
+        # Transformaciones EPSG:4326 -> CRS del mapa, por authid de destino
+        self._crs_4326 = QgsCoordinateReferenceSystem("EPSG:4326")
+        self._xform_cache = {}
+        # Conectado mientras el dock está visible (showEvent/closeEvent): sin conexiones
+        # colgando del singleton QgsProject tras cerrar o recargar el plugin
+        self._crs_connected = False
 
 
         # card visuals
@@ -128,6 +203,7 @@ class SceneBrowserDock(QDockWidget):
         self._thumb_zoom_level = 5
         self._scene_buttons = []  # refs para actualizar tamaño
         self._build_ui()
+        self._prune_crop_cache()
 
     def _set_status_info(self, text):
         self.lbl_status.setText(text)
@@ -329,7 +405,7 @@ class SceneBrowserDock(QDockWidget):
                     a2 = "swir22" if "swir22" in assets else ("swir2" if "swir2" in assets else None)
                     if a2 is None:
                         raise RuntimeError("No se encontró banda SWIR2 (swir22/swir2).")
-                rlayer, vrt, buf = self._crop_assets_to_index_tif(assets, mode.upper(), a1, a2, "s2", layer_title)
+                prefix = "s2"
             else:
                 nir = "nir08" if "nir08" in assets else ("nir" if "nir" in assets else None)
                 if nir is None:
@@ -341,16 +417,27 @@ class SceneBrowserDock(QDockWidget):
                     if sw2 is None:
                         raise RuntimeError("No se encontró banda SWIR2 (swir22/swir2).")
                     a1, a2 = nir, sw2
-                rlayer, vrt, buf = self._crop_assets_to_index_tif(assets, mode.upper(), a1, a2, "ls", layer_title)
-
-            self._apply_index_colorramp(rlayer, mode.upper())
-            group = "Índices (S2)" if kind == "s2" else "Índices (Landsat)"
-            self._put_layer_in_group_add(rlayer, group)
-            self._zoom_to_buffer(buf)
-            self.lbl_status.setText(f"{mode.upper()} listo")
+                prefix = "ls"
+
+            def _ready(path, buf):
+                rlayer = QgsRasterLayer(path, layer_title)
+                if not rlayer.isValid():
+                    raise RuntimeError("No se pudo crear la capa de índice")
+                self._apply_index_colorramp(rlayer, mode.upper())
+                group = "Índices (S2)" if kind == "s2" else "Índices (Landsat)"
+                self._put_layer_in_group_add(rlayer, group)
+                self._zoom_to_buffer(buf)
+                self.lbl_status.setText(f"{mode.upper()} listo")
+
+            self.lbl_status.setText(f"Calculando {mode.upper()}…")
+            self._start_crop(assets, [a1, a2], prefix, index_mode=mode.upper(),
+                             on_ready=_ready, on_error=partial(self._on_index_error, mode.upper()))
         except Exception as e:
-            QMessageBox.critical(self, "Scene Browser", f"No se pudo generar {mode.upper()}:\n{e}")
-            self.lbl_status.setText(f"Error {mode.upper()}")
+            self._on_index_error(mode.upper(), str(e))
+
+    def _on_index_error(self, mode: str, message: str):
+        QMessageBox.critical(self, "Scene Browser", f"No se pudo generar {mode}:\n{message}")
+        self.lbl_status.setText(f"Error {mode}")
 
     def on_ndvi_clicked(self):
         self._compute_index_for_last("NDVI")
@@ -361,30 +448,65 @@ class SceneBrowserDock(QDockWidget):
 
     def _clear_grid(self):
         self._scene_buttons = []
-        while self.grid.count():
-            it = self.grid.takeAt(0)
-            w = it.widget()
+        # Thumbnails aún no lanzados ya no tienen botón destino
+        self._drop_pending_thumbs()
+        # Sin repintado mientras se vacía y se repuebla la grilla (un solo re-layout);
+        # _populate_list lo reactiva, y el timer lo garantiza si no llega a ejecutarse.
+        self._set_grid_updates_enabled(False)
+        QTimer.singleShot(0, lambda: self._set_grid_updates_enabled(True))
+        for i in reversed(range(self.grid.count())):
+            w = self.grid.itemAt(i).widget()
             if w:
+                self.grid.removeWidget(w)
+                w.setParent(None)
                 w.deleteLater()
 
+    def _drop_pending_thumbs(self):
+        while self._thumb_pending:
+            key, _task = self._thumb_pending.popleft()
+            self._thumb_tasks.pop(key, None)
+
+    def _set_grid_updates_enabled(self, enabled: bool):
+        self.scroll.setUpdatesEnabled(enabled)
+        self.grid_container.setUpdatesEnabled(enabled)
+
     def _cache_dir(self):
         p = os.path.join(QgsApplication.qgisSettingsDirPath(), "scene_browser_cache", "previews")
         os.makedirs(p, exist_ok=True)
         return p
 
+    def _prune_crop_cache(self, keep: int = CROP_CACHE_MAX_FILES):
+        """Conserva solo los `keep` recortes cacheados de uso más reciente (LRU)."""
+        try:
+            d = self._cache_dir()
+            entries = []
+            for name in os.listdir(d):
+                if _CROP_CACHE_RE.match(name):
+                    path = os.path.join(d, name)
+                    st = os.stat(path)
+                    entries.append((max(st.st_atime, st.st_mtime), path))
+            entries.sort(reverse=True)
+            for _ts, path in entries[keep:]:
+                os.remove(path)
+        except OSError:
+            pass
+
     def _thumb_dir(self):
         p = os.path.join(QgsApplication.qgisSettingsDirPath(), "scene_browser_cache", "thumbs")
         os.makedirs(p, exist_ok=True)
         return p
 
     def _aoi_bbox_and_buffer(self):
-        geom, crs = geom_from_xy(self.txt_x.text(), self.txt_y.text(), "EPSG:4326")
-        buf5 = buffer_5km_epsg4326(geom, crs)
-        buf3 = buffer_3km_epsg4326(geom, crs)
+        key = (self.txt_x.text().strip(), self.txt_y.text().strip())
+        if self._buffer_cache[0] != key:
+            geom, crs = geom_from_xy(self.txt_x.text(), self.txt_y.text(), "EPSG:4326")
+            buf5 = buffer_5km_epsg4326(geom, crs)
+            buf3 = buffer_3km_epsg4326(geom, crs)
+            self._buffer_cache = (key, (buf5, _bbox_tuple(buf5)), (buf3, _bbox_tuple(buf3)))
+        _key, (buf5, bbox5), (buf3, _bbox3) = self._buffer_cache
         self._last_buffer = buf5
         self._last_thumb_buffer = buf3
-        rect = buf5.boundingBox()
-        return [rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum()]
+        return list(bbox5)
 
     def _ensure_thumb_buffer(self):
         if self._last_thumb_buffer is None:
@@ -396,13 +518,25 @@ class SceneBrowserDock(QDockWidget):
             raise RuntimeError("AOI no definido. Realiza una búsqueda primero.")
         return self._last_buffer
 
+    def _buffer_bbox(self, thumb: bool = False):
+        """(buffer, bbox) de la última búsqueda, con el bbox ya calculado."""
+        buf = self._ensure_thumb_buffer() if thumb else self._ensure_buffer()
+        for entry in self._buffer_cache[1:]:
+            if entry is not None and entry[0] is buf:
+                return entry
+        return buf, _bbox_tuple(buf)
+
     def _zoom_to_buffer(self, buf_geom4326):
         canvas = self.iface.mapCanvas()
         dest_crs = canvas.mapSettings().destinationCrs()
-        wgs84 = QgsCoordinateReferenceSystem("EPSG:4326")
 
         if dest_crs.authid() != "EPSG:4326":
-            tr = QgsCoordinateTransform(wgs84, dest_crs, QgsProject.instance())
+            # Clave WKT: los CRS personalizados no tienen authid
+            key = dest_crs.toWkt()
+            tr = self._xform_cache.get(key)
+            if tr is None:
+                tr = QgsCoordinateTransform(self._crs_4326, dest_crs, QgsProject.instance())
+                self._xform_cache[key] = tr
             g2 = QgsGeometry(buf_geom4326)
             g2.transform(tr)
             canvas.setExtent(g2.boundingBox())
@@ -412,7 +546,7 @@ class SceneBrowserDock(QDockWidget):
         canvas.refresh()
 
     def _sorted_features(self, data):
-        feats = data.get("features", [])
+        feats = self._filter_features_for_aoi(data.get("features", []))
 
         def _dt(f):
             p = f.get("properties", {})
@@ -420,6 +554,31 @@ class SceneBrowserDock(QDockWidget):
         feats.sort(key=_dt, reverse=True)
         return feats
 
+    def _filter_features_for_aoi(self, feats):
+        """Descarta escenas cuya huella no contiene el punto AOI o con nubosidad
+        sobre tierra mayor al máximo (evita thumbnails vacíos y lecturas inútiles)."""
+        try:
+            pt = QgsGeometry.fromPointXY(QgsPointXY(float(self.txt_x.text().strip()), float(self.txt_y.text().strip())))
+        except Exception:
+            pt = None
+        max_cloud = float(self.spin_cloud.value())
+
+        kept = []
+        for f in feats:
+            p = f.get("properties", {}) or {}
+            land_cloud = p.get("eo:cloud_cover_land", p.get("landsat:cloud_cover_land"))
+            if land_cloud is not None and float(land_cloud) > max_cloud:
+                continue
+            if pt is not None:
+                try:
+                    footprint = footprint_geometry(f.get("geometry"))
+                except Exception:
+                    footprint = None
+                if footprint is not None and not footprint.isEmpty() and not footprint.contains(pt):
+                    continue
+            kept.append(f)
+        return kept
+
     def _feature_label(self, f):
         sid = f.get("id", "")
         p = f.get("properties", {})
@@ -429,8 +588,8 @@ class SceneBrowserDock(QDockWidget):
 
     def _populate_list(self, feats, handler, thumb_kind):
         # ONE COLUMN
-        row = 0
-        for f in feats:
+        self._scene_buttons = [None] * len(feats)
+        for row, f in enumerate(feats):
             date, sid = self._feature_label(f)
 
             btn = QToolButton()
@@ -444,17 +603,40 @@ class SceneBrowserDock(QDockWidget):
             )
             btn.clicked.connect(partial(handler, f))
 
-            self._scene_buttons.append(btn)
+            self._scene_buttons[row] = btn
 
-            # placeholder icon (gray)
-            pm = QPixmap(self._thumb_icon_px, self._thumb_icon_px)
-            pm.fill(Qt.lightGray)
-            btn.setIcon(QIcon(pm))
+            btn.setIcon(self._placeholder_icon(self._thumb_icon_px))
 
             self.grid.addWidget(btn, row, 0)
             self._start_thumbnail(btn, f, thumb_kind)
-            row += 1
+        self._set_grid_updates_enabled(True)
+
 
+    def _placeholder_icon(self, px: int):
+        """Icono gris de espera (uno por tamaño)."""
+        icon = self._placeholder_icons.get(px)
+        if icon is None:
+            pm = QPixmap(px, px)
+            pm.fill(Qt.lightGray)
+            icon = QIcon(pm)
+            self._placeholder_icons[px] = icon
+        return icon
+
+    def _icon_for(self, png_path: str):
+        """QIcon del PNG con cache LRU por (ruta, mtime): evita re-decodificar al refrescar."""
+        try:
+            key = (png_path, os.path.getmtime(png_path))
+        except OSError:
+            return QIcon(png_path)
+        icon = self._icon_cache.get(key)
+        if icon is not None:
+            self._icon_cache.move_to_end(key)
+            return icon
+        icon = QIcon(QPixmap(png_path))
+        self._icon_cache[key] = icon
+        if len(self._icon_cache) > self._icon_cache_max:
+            self._icon_cache.popitem(last=False)
+        return icon
 
     def _draw_point_marker(self, png_path: str, bbox4326, size_px: int):
         """Dibuja un punto amarillo (coordenada ingresada) sobre el thumbnail PNG."""
@@ -495,9 +677,7 @@ class SceneBrowserDock(QDockWidget):
         por eso el cache incluye el preset para evitar reutilizar Natural.
         """
         try:
-            buf = self._ensure_thumb_buffer()
-            rect = buf.boundingBox()
-            bbox = (rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum())
+            buf, bbox = self._buffer_bbox(thumb=True)
 
             assets = feature.get("assets", {}) or {}
             preset = self.cmb_preset.currentText()
@@ -505,7 +685,7 @@ class SceneBrowserDock(QDockWidget):
             if kind == "s2":
                 rgb = s2_assets_for_preset(preset)
             else:
-                rgb = [a for a in ls_assets_for_preset(preset, assets.keys()) if a]
+                rgb = [a for a in ls_assets_for_preset(preset, frozenset(assets)) if a]
 
             if not rgb or len(rgb) != 3 or any(a not in assets for a in rgb):
                 return
@@ -521,7 +701,7 @@ class SceneBrowserDock(QDockWidget):
             png_path = os.path.join(self._thumb_dir(), f"thumb_{kind}_{preset_safe}_{coord_safe}_{fid}.png")
 
             if os.path.exists(png_path):
-                btn.setIcon(QIcon(png_path))
+                btn.setIcon(self._icon_for(png_path))
                 return
 
             task = ThumbnailTask("Thumbnail…", self._thumb_dir(), assets, rgb, bbox, size_px=self._thumb_png_px)
@@ -543,26 +723,40 @@ class SceneBrowserDock(QDockWidget):
                             self._draw_point_marker(png_path_local, bbox, self._thumb_png_px)
                         except Exception:
                             pass
-                        btn.setIcon(QIcon(png_path_local))
+                        btn.setIcon(self._icon_for(png_path_local))
                     else:
                         if getattr(task, "error", None):
                             from qgis.core import QgsMessageLog, Qgis
                             QgsMessageLog.logMessage(f"Thumbnail no generado: {task.error}", "SceneBrowser", Qgis.Warning)
                 finally:
                     self._thumb_tasks.pop(key, None)
+                    self._thumb_task_done()
 
             def _on_terminated():
                 from qgis.core import QgsMessageLog, Qgis
                 QgsMessageLog.logMessage("Thumbnail task terminated", "SceneBrowser", Qgis.Warning)
                 self._thumb_tasks.pop(key, None)
+                self._thumb_task_done()
 
             task.taskCompleted.connect(_apply_icon)
             task.taskTerminated.connect(_on_terminated)
 
-            QgsApplication.taskManager().addTask(task)
+            self._thumb_pending.append((key, task))
+            self._pump_thumb_queue()
         except Exception:
             return
 
+    def _pump_thumb_queue(self):
+        """Lanza thumbnails pendientes mientras haya huecos libres."""
+        while self._thumb_pending and self._thumb_inflight < self._thumb_max_inflight:
+            _key, task = self._thumb_pending.popleft()
+            self._thumb_inflight += 1
+            QgsApplication.taskManager().addTask(task)
+
+    def _thumb_task_done(self):
+        self._thumb_inflight = max(0, self._thumb_inflight - 1)
+        self._pump_thumb_queue()
+
 
     def refresh_scene_list(self):
         """Actualiza la lista (miniaturas) cuando cambia la combinación de bandas.
@@ -618,26 +812,30 @@ class SceneBrowserDock(QDockWidget):
         collection_id = (collection_id or "").strip()
         if not collection_id:
             return ""
-        if collection_id in self._pc_token_cache:
-            return self._pc_token_cache[collection_id]
+        cached = self._pc_token_cache.get(collection_id)
+        if cached and time.time() < cached[1] - PC_TOKEN_REFRESH_MARGIN:
+            return cached[0]
         url = f"https://planetarycomputer.microsoft.com/api/sas/v1/token/{collection_id}"
-        r = requests.get(url, timeout=30)
+        r = self._http.get(url, timeout=30)
         r.raise_for_status()
-        token = r.json().get("token", "")
-        self._pc_token_cache[collection_id] = token
+        payload = r.json()
+        token = payload.get("token", "")
+        self._pc_token_cache[collection_id] = (token, _pc_token_expiry(payload, token))
         return token
 
     def _pc_sign_features(self, features, collection_id: str):
+        if not features:
+            return features
         token = self._pc_get_token(collection_id)
         if not token:
             return features
+        # Sufijo precalculado una vez; una sola lectura de href por asset
+        sep = "?" + token
         for f in features:
-            assets = f.get("assets") or {}
-            for a in assets.values():
-                href = a.get("href")
-                if not href or "?" in href:
-                    continue
-                a["href"] = href + "?" + token
+            for a in (f.get("assets") or {}).values():
+                h = a.get("href")
+                if h and "?" not in h:
+                    a["href"] = h + sep
         return features
 
     def search_landsat(self):
@@ -705,143 +903,62 @@ class SceneBrowserDock(QDockWidget):
             pass
 
 
-    def _crop_assets_to_index_tif(self, assets_dict, mode: str, a1: str, a2: str, prefix: str, layer_title: str):
-        """Recorta 2 assets (COG) al bbox del buffer y calcula un índice (NDVI/NBR).
-        Re-muestrea la 2da banda a la grilla de la 1ra (p.ej. SWIR 20m vs NIR 10m).
-        """
-        buf = self._ensure_buffer()
-        rect = buf.boundingBox()
-        bbox = (rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum())
-
-        out_dir = self._cache_dir()
-        uid = uuid.uuid4().hex
-
-        def _crop_one(asset_name: str):
-            href = assets_dict[asset_name]["href"]
-            src = _src_from_href(href)
-            out_tif = os.path.join(out_dir, f"{prefix}_{uid}_{asset_name}.tif")
-            gdal.Translate(
-                out_tif,
-                src,
-                options=gdal.TranslateOptions(
-                    projWin=[bbox[0], bbox[3], bbox[2], bbox[1]],
-                    projWinSRS="EPSG:4326",
-                    format="GTiff",
-                    creationOptions=["TILED=YES", "COMPRESS=DEFLATE"],
-                ),
-            )
-            return out_tif
-
-        # Fallback SWIR2 (algunas colecciones usan "swir2" en vez de "swir22")
-        if mode.upper() == "NBR" and a2 not in assets_dict and "swir2" in assets_dict:
-            a2 = "swir2"
-
-        t1 = _crop_one(a1)
-        t2 = _crop_one(a2)
-
-        ds1 = gdal.Open(t1)
-        ds2 = gdal.Open(t2)
-
-        # Re-muestrear banda 2 a la grilla de ds1
-        gt = ds1.GetGeoTransform()
-        xsize = ds1.RasterXSize
-        ysize = ds1.RasterYSize
-        xmin = gt[0]
-        ymax = gt[3]
-        xmax = xmin + gt[1] * xsize
-        ymin = ymax + gt[5] * ysize
-
-        t2m = os.path.join(out_dir, f"{prefix}_{uid}_{a2}_match.tif")
-        gdal.Warp(
-            t2m,
-            ds2,
-            options=gdal.WarpOptions(
-                format="GTiff",
-                dstSRS=ds1.GetProjection(),
-                outputBounds=[xmin, ymin, xmax, ymax],
-                width=xsize,
-                height=ysize,
-                resampleAlg="bilinear",
-                creationOptions=["TILED=YES", "COMPRESS=DEFLATE"],
-            ),
-        )
-        ds2m = gdal.Open(t2m)
-
-        b1 = ds1.GetRasterBand(1).ReadAsArray().astype("float32")
-        b2 = ds2m.GetRasterBand(1).ReadAsArray().astype("float32")
-
-        # ✅ Apply reflectance scaling ONLY for Landsat C2 L2
-        # Sentinel-2 assets from EarthSearch are already reflectance-like; do not scale them.
-        if prefix.lower() == "ls":
-            b1 = b1 * LS_SR_MULT + LS_SR_ADD
-            b2 = b2 * LS_SR_MULT + LS_SR_ADD
-
-        denom = (b1 + b2)
-
-        with np.errstate(divide="ignore", invalid="ignore"):
-            idx = (b1 - b2) / denom
-
-        # Clean non-finite and (optional) hard clip to [-1, 1] to match expected index domain
-        idx[~np.isfinite(idx)] = -9999.0
-        idx = np.where(idx == -9999.0, -9999.0, np.clip(idx, -1.0, 1.0)).astype("float32")
-
-        out_idx = os.path.join(out_dir, f"{prefix}_{uid}_{mode}.tif")
-        drv = gdal.GetDriverByName("GTiff")
-        out_ds = drv.Create(
-            out_idx,
-            xsize,
-            ysize,
-            1,
-            gdal.GDT_Float32,
-            options=["TILED=YES", "COMPRESS=DEFLATE"],
-        )
-        out_ds.SetGeoTransform(ds1.GetGeoTransform())
-        out_ds.SetProjection(ds1.GetProjection())
-        ob = out_ds.GetRasterBand(1)
-        ob.WriteArray(idx)
-        ob.SetNoDataValue(-9999.0)
-        ob.FlushCache()
-        out_ds.FlushCache()
-        out_ds = None
-
-        rlayer = QgsRasterLayer(out_idx, layer_title)
-        if not rlayer.isValid():
-            raise RuntimeError("No se pudo crear la capa de índice")
-        return rlayer, out_idx, buf
-
-
-    def _crop_assets_to_vrt(self, assets_dict, asset_names, prefix, layer_title):
-        buf = self._ensure_buffer()
-        rect = buf.boundingBox()
-        bbox = (rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum())
-
-        out_dir = self._cache_dir()
-        uid = uuid.uuid4().hex
-        tifs = []
-
-        for a in asset_names:
-            href = assets_dict[a]["href"]
-            src = _src_from_href(href)
-            out_tif = os.path.join(out_dir, f"{prefix}_{uid}_{a}.tif")
-            gdal.Translate(
-                out_tif,
-                src,
-                options=gdal.TranslateOptions(
-                    projWin=[bbox[0], bbox[3], bbox[2], bbox[1]],
-                    projWinSRS="EPSG:4326",
-                    format="GTiff",
-                    creationOptions=["TILED=YES", "COMPRESS=DEFLATE"]
-                )
-            )
-            tifs.append(out_tif)
-
-        out_vrt = os.path.join(out_dir, f"{prefix}_{uid}.vrt")
-        gdal.BuildVRT(out_vrt, tifs, separate=True)
-
-        rlayer = QgsRasterLayer(out_vrt, layer_title)
-        if not rlayer.isValid():
-            raise RuntimeError("No se pudo cargar el VRT en QGIS.")
-        return rlayer, out_vrt, buf
+    def _get_executor(self):
+        # Se crea bajo demanda: cerrar el dock lo apaga y reabrirlo crea uno nuevo
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=max(4, os.cpu_count() or 4))
+        return self._executor
+
+    def _on_project_crs_changed(self):
+        self._xform_cache.clear()
+
+    def showEvent(self, event):
+        if not self._crs_connected:
+            QgsProject.instance().crsChanged.connect(self._on_project_crs_changed)
+            self._crs_connected = True
+            self._xform_cache.clear()  # el CRS pudo cambiar con el dock cerrado
+        super().showEvent(event)
+
+    def closeEvent(self, event):
+        if self._crs_connected:
+            QgsProject.instance().crsChanged.disconnect(self._on_project_crs_changed)
+            self._crs_connected = False
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        # Thumbnails: se descartan los pendientes y se cancelan los en curso (cada uno
+        # libera sus intermedios /vsimem); el barrido de /vsimem queda para unload
+        self._drop_pending_thumbs()
+        for task in list(self._thumb_tasks.values()):
+            task.cancel()
+        super().closeEvent(event)
+
+    def _start_crop(self, assets, asset_names, prefix: str, index_mode=None, on_ready=None, on_error=None,
+                    epsg=None):
+        """Lanza el recorte (VRT o índice) como QgsTask; `on_ready(path, buf)` corre en la GUI."""
+        buf, bbox = self._buffer_bbox()
+        desc = f"{index_mode.upper()}…" if index_mode else "Preview…"
+        task = CropToVrtTask(desc, self._cache_dir(), assets, asset_names, bbox, prefix,
+                             index_mode=index_mode, epsg=epsg, executor=self._get_executor())
+        self._crop_tasks.add(task)
+
+        def _done():
+            self._crop_tasks.discard(task)
+            try:
+                on_ready(task.out_path, buf)
+            except Exception as e:
+                if on_error:
+                    on_error(str(e))
+
+        def _failed():
+            self._crop_tasks.discard(task)
+            if on_error:
+                on_error(task.error or "Tarea cancelada")
+
+        task.taskCompleted.connect(_done)
+        task.taskTerminated.connect(_failed)
+        QgsApplication.taskManager().addTask(task)
+        return task
 
     def _apply_stretch_async(self, rlayer, vrt_path, done_text):
         task = PercentileStretchTask("Stretch 2–98…", vrt_path, p_low=2, p_high=98)
@@ -851,6 +968,21 @@ class SceneBrowserDock(QDockWidget):
                 self.lbl_status.setText(done_text + " (sin stretch)")
                 return
 
+            # Stretch "horneado" en el VRT: la capa apunta al VRT Byte ya estirado, que
+            # se reutiliza en previews siguientes y al reabrir el proyecto
+            try:
+                ranges = [task.result["r"], task.result["g"], task.result["b"]]
+                baked = bake_stretch_into_vrt(vrt_path, ranges, task.p_low, task.p_high)
+                rlayer.setDataSource(baked, rlayer.name(), "gdal")
+                if rlayer.isValid():
+                    rlayer.setRenderer(QgsMultiBandColorRenderer(rlayer.dataProvider(), 1, 2, 3))
+                    rlayer.triggerRepaint()
+                    self.lbl_status.setText(done_text + " ✓")
+                    return
+                rlayer.setDataSource(vrt_path, rlayer.name(), "gdal")
+            except Exception:
+                pass
+
             prov = rlayer.dataProvider()
             renderer = QgsMultiBandColorRenderer(prov, 1, 2, 3)
 
@@ -876,49 +1008,25 @@ class SceneBrowserDock(QDockWidget):
         QgsApplication.taskManager().addTask(task)
 
     def preview_s2(self, feature):
-        try:
-            self.lbl_status.setText("Creando preview S2 (5 km)…")
-            self._last_selected_feature = feature
-            self._last_selected_kind = "s2"
-            self.btn_ndvi.setEnabled(True)
-            self.btn_nbr.setEnabled(True)
-            preset = self.cmb_preset.currentText()
-            assets_need = s2_assets_for_preset(preset)
-
-            assets = feature.get("assets", {}) or {}
-            missing = [a for a in assets_need if not (isinstance(a, str) and a.startswith('__')) and a not in assets]
-            if missing:
-                raise RuntimeError(f"Faltan assets {missing}. Disponibles: {list(assets.keys())[:16]}...")
-
-            title = f"S2 {preset} | {feature.get('id','')}"
-            if assets_need and str(assets_need[0]).startswith("__"):
-                mode = assets_need[0].strip("_")
-                rlayer, vrt, buf = self._crop_assets_to_index_tif(assets, mode, assets_need[1], assets_need[2], "s2", title)
-            else:
-                rlayer, vrt, buf = self._crop_assets_to_vrt(assets, assets_need, "s2", title)
-
-            self._put_layer_in_group_add(rlayer, "Previews S2")
-            self._zoom_to_buffer(buf)
-            if isinstance(vrt, str) and vrt.lower().endswith('.vrt'):
-                self._apply_stretch_async(rlayer, vrt, "Preview S2 listo")
-            else:
-                self.lbl_status.setText("Preview S2 listo ✓")
-        except Exception as e:
-            self.lbl_status.setText("")
-            QMessageBox.critical(self, "Error preview (S2)", str(e))
+        self._preview("s2", feature)
 
     def preview_landsat(self, feature):
+        self._preview("ls", feature)
+
+    def _preview(self, kind: str, feature):
+        """Preview (5 km) de una escena: resuelve los assets del preset y lanza el recorte."""
+        label, assets_fn, group_name = _PREVIEW_KINDS[kind]
         try:
-            self.lbl_status.setText("Creando preview Landsat (5 km)…")
+            self.lbl_status.setText(f"Creando preview {label} (5 km)…")
             self._last_selected_feature = feature
-            self._last_selected_kind = "ls"
+            self._last_selected_kind = kind
             self.btn_ndvi.setEnabled(True)
             self.btn_nbr.setEnabled(True)
             preset = self.cmb_preset.currentText()
 
             assets = feature.get("assets", {}) or {}
-            available = set(assets.keys())
-            assets_need = [a for a in ls_assets_for_preset(preset, available) if a]
+            available = frozenset(assets)
+            assets_need = [a for a in assets_fn(preset, available) if a]
             if len(assets_need) != 3:
                 raise RuntimeError(f"No pude determinar 3 assets para {preset}. Disponibles: {list(available)[:20]}...")
 
@@ -926,22 +1034,49 @@ class SceneBrowserDock(QDockWidget):
             if missing:
                 raise RuntimeError(f"Faltan assets {missing}. Disponibles: {list(available)[:20]}...")
 
-            title = f"Landsat {preset} | {feature.get('id','')}"
-            if assets_need and str(assets_need[0]).startswith("__"):
-                mode = assets_need[0].strip("_")
-                rlayer, vrt, buf = self._crop_assets_to_index_tif(assets, mode, assets_need[1], assets_need[2], "ls", title)
-            else:
-                rlayer, vrt, buf = self._crop_assets_to_vrt(assets, assets_need, "ls", title)
-
-            self._put_layer_in_group_add(rlayer, "Previews Landsat")
+            title = f"{label} {preset} | {feature.get('id','')}"
+            self._start_preview(assets, assets_need, kind, title, group_name, f"Preview {label} listo",
+                                f"Error preview ({label})", epsg=feature_epsg(feature))
+        except Exception as e:
+            self.lbl_status.setText("")
+            QMessageBox.critical(self, f"Error preview ({label})", str(e))
+
+    def _start_preview(self, assets, assets_need, prefix: str, title: str, group_name: str,
+                       done_text: str, error_title: str, epsg=None):
+        """Recorte en background; al terminar agrega la capa, hace zoom y lanza el stretch."""
+        index_mode = None
+        if assets_need and str(assets_need[0]).startswith("__"):
+            index_mode = assets_need[0].strip("_")
+            assets_need = assets_need[1:3]
+
+        def _ready(path, buf):
+            baked = None if index_mode else stretched_vrt_path(path, 2, 98)
+            if baked and os.path.exists(baked):
+                # Mismo recorte ya estirado antes: sin recalcular percentiles
+                rlayer = QgsRasterLayer(baked, title)
+                if rlayer.isValid():
+                    os.utime(baked)  # LRU de _prune_crop_cache
+                    rlayer.setRenderer(QgsMultiBandColorRenderer(rlayer.dataProvider(), 1, 2, 3))
+                    self._put_layer_in_group_add(rlayer, group_name)
+                    self._zoom_to_buffer(buf)
+                    self.lbl_status.setText(done_text + " ✓")
+                    return
+            rlayer = QgsRasterLayer(path, title)
+            if not rlayer.isValid():
+                raise RuntimeError("No se pudo cargar el VRT en QGIS.")
+            self._put_layer_in_group_add(rlayer, group_name)
             self._zoom_to_buffer(buf)
-            if isinstance(vrt, str) and vrt.lower().endswith('.vrt'):
-                self._apply_stretch_async(rlayer, vrt, "Preview Landsat listo")
+            if not index_mode:
+                self._apply_stretch_async(rlayer, path, done_text)
             else:
-                self.lbl_status.setText("Preview Landsat listo ✓")
-        except Exception as e:
+                self.lbl_status.setText(done_text + " ✓")
+
+        def _error(message):
             self.lbl_status.setText("")
-            QMessageBox.critical(self, "Error preview (Landsat)", str(e))
+            QMessageBox.critical(self, error_title, message)
+
+        self._start_crop(assets, assets_need, prefix, index_mode=index_mode, on_ready=_ready, on_error=_error,
+                         epsg=epsg)
 
     def _put_layer_in_group_add(self, layer, group_name: str):
         proj = QgsProject.instance()
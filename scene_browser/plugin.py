@@ -1,6 +1,9 @@
 from qgis.PyQt.QtWidgets import QAction
 from qgis.PyQt.QtGui import QIcon
 import os
+from .core.crop_tasks import clear_dataset_cache
+from .core.gdal_env import configure_gdal_for_cog, reset_gdal_config
+from .core.thumb_tasks import clear_vsimem
 from .gui.dockwidget import SceneBrowserDock
 
 
@@ -11,6 +14,9 @@ class SceneBrowserPlugin:
         self.dock = None
 
     def initGui(self):
+        # Opciones GDAL globales (caches, hilos); las de lectura remota se limitan
+        # a los servidores/buckets de los assets del plugin (ver core.gdal_env)
+        configure_gdal_for_cog()
         self.action = QAction(QIcon(os.path.join(os.path.dirname(__file__), "icon.png")), "Visor de escenas Sentinel 2 y Landsat -Sernanp", self.iface.mainWindow())
         self.action.triggered.connect(self.open_dock)
         self.iface.addToolBarIcon(self.action)
@@ -21,8 +27,12 @@ class SceneBrowserPlugin:
             self.iface.removeToolBarIcon(self.action)
             self.iface.removePluginMenu("&Visor de escenas-SERNANP", self.action)
         if self.dock:
+            self.dock.close()  # closeEvent libera el pool de hilos y cancela thumbnails
             self.iface.removeDockWidget(self.dock)
             self.dock = None
+        clear_vsimem()
+        clear_dataset_cache()
+        reset_gdal_config()
 
     def open_dock(self):
         if not self.dock: